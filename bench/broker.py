@@ -0,0 +1,289 @@
+# minimal in-process MQTT v5 broker for the benchmark: plain TCP, QoS 0/1, wildcards, $share/<group>/<filter> subscriptions
+# with round-robin dispatch honouring each client's Receive Maximum, and redelivery of unacknowledged shared messages when a
+# member disconnects. Enough for paho-mqtt as used by the scripts, nothing more (no retain, no will, no QoS 2, no persistence)
+import asyncio
+import socket
+import struct
+import threading
+from time import time
+
+CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 1, 2, 3, 4, 8, 9, 10, 11, 12, 13, 14
+
+# MQTT v5 property identifiers grouped by their encoding, needed to skip over properties we do not care about
+PROP_BYTE = {0x01, 0x17, 0x19, 0x24, 0x25, 0x28, 0x29, 0x2A}
+PROP_U16 = {0x13, 0x21, 0x22, 0x23}
+PROP_U32 = {0x02, 0x11, 0x18, 0x27}
+PROP_VARINT = {0x0B}
+PROP_STRING = {0x03, 0x08, 0x12, 0x15, 0x1A, 0x1C, 0x1F}
+PROP_BINARY = {0x09, 0x16}
+PROP_PAIR = {0x26}
+RECEIVE_MAXIMUM = 0x21
+
+def encode_varint(n:int) -> bytes:
+   out = bytearray()
+   while True:
+      b = n % 128
+      n //= 128
+      out.append(b | 0x80 if n > 0 else b)
+      if n == 0:
+         return bytes(out)
+
+def decode_varint(data:bytes, idx:int) -> tuple:
+   mult, value = 1, 0
+   while True:
+      b = data[idx]
+      idx += 1
+      value += (b & 0x7F) * mult
+      if b & 0x80 == 0:
+         return (value, idx)
+      mult *= 128
+
+def encode_string(s) -> bytes:
+   b = s.encode('utf-8') if isinstance(s, str) else s
+   return struct.pack('!H', len(b)) + b
+
+def decode_string(data:bytes, idx:int) -> tuple:
+   n = struct.unpack_from('!H', data, idx)[0]
+   return (data[idx + 2:idx + 2 + n].decode('utf-8'), idx + 2 + n)
+
+def decode_properties(data:bytes, idx:int) -> tuple:
+   length, idx = decode_varint(data, idx)
+   end = idx + length
+   props = {}
+   while idx < end:
+      pid, idx = decode_varint(data, idx)
+      if pid in PROP_BYTE:
+         props[pid] = data[idx]
+         idx += 1
+      elif pid in PROP_U16:
+         props[pid] = struct.unpack_from('!H', data, idx)[0]
+         idx += 2
+      elif pid in PROP_U32:
+         props[pid] = struct.unpack_from('!I', data, idx)[0]
+         idx += 4
+      elif pid in PROP_VARINT:
+         props[pid], idx = decode_varint(data, idx)
+      elif pid in PROP_STRING or pid in PROP_BINARY:
+         n = struct.unpack_from('!H', data, idx)[0]
+         props[pid] = data[idx + 2:idx + 2 + n]
+         idx += 2 + n
+      elif pid in PROP_PAIR:
+         for i in range(2):
+            n = struct.unpack_from('!H', data, idx)[0]
+            idx += 2 + n
+      else:
+         raise ValueError(f"unknown MQTT property {pid}")
+   return (props, end)
+
+def packet(ptype:int, flags:int, body:bytes) -> bytes:
+   return bytes([(ptype << 4) | flags]) + encode_varint(len(body)) + body
+
+def topic_matches(topic_filter:str, topic:str) -> bool:
+   f = topic_filter.split('/')
+   t = topic.split('/')
+   if topic.startswith('$') and not topic_filter.startswith('$'):
+      return False
+   for i, part in enumerate(f):
+      if part == '#':
+         return True
+      if i >= len(t) or (part != '+' and part != t[i]):
+         return False
+   return len(f) == len(t)
+
+class Session:
+   def __init__(self, client_id:str, writer, receive_maximum:int):
+      self.client_id = client_id
+      self.writer = writer
+      self.receive_maximum = receive_maximum
+      self.subscriptions = {} # filter -> qos, non-shared only
+      self.inflight = {} # packet id -> (topic, payload, group) awaiting PUBACK
+      self.next_pid = 1
+
+   def send(self, data:bytes) -> None:
+      if not self.writer.is_closing():
+         self.writer.write(data)
+
+   def can_accept(self) -> bool:
+      return len(self.inflight) < self.receive_maximum
+
+   def deliver(self, topic:str, payload:bytes, qos:int, group=None) -> None:
+      body = encode_string(topic)
+      if qos > 0:
+         pid = self.next_pid
+         self.next_pid = self.next_pid % 65535 + 1
+         self.inflight[pid] = (topic, payload, group)
+         body += struct.pack('!H', pid)
+      body += encode_varint(0) + payload
+      self.send(packet(PUBLISH, qos << 1, body))
+
+class SharedGroup:
+   def __init__(self):
+      self.members = [] # (session, qos)
+      self.pending = [] # (topic, payload, qos) waiting for a member with room
+      self.next_member = 0
+
+class Broker:
+   def __init__(self, host:str='127.0.0.1', port:int=0, on_publish=None, on_deliver=None):
+      # on_publish(client_id, topic, payload, t) and on_deliver(client_id, topic, payload, t) let the benchmark observe traffic
+      self.host = host
+      self.port = port
+      self.on_publish = on_publish
+      self.on_deliver = on_deliver
+      self.sessions = {}
+      self.groups = {} # (group, filter) -> SharedGroup
+      self.loop = None
+      self.server = None
+      self.ready = threading.Event()
+
+   def start(self) -> int:
+      # runs the broker's event loop in a daemon thread, returns the port it listens on
+      threading.Thread(target=self.run, daemon=True).start()
+      self.ready.wait()
+      return self.port
+
+   def run(self) -> None:
+      self.loop = asyncio.new_event_loop()
+      self.server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.host, self.port))
+      self.port = self.server.sockets[0].getsockname()[1]
+      self.ready.set()
+      self.loop.run_forever()
+
+   def stop(self) -> None:
+      if self.loop:
+         self.loop.call_soon_threadsafe(self.loop.stop)
+
+   def dispatch_group(self, group:SharedGroup) -> None:
+      while any(group.pending) and any(group.members):
+         for i in range(len(group.members)):
+            session, qos = group.members[(group.next_member + i) % len(group.members)]
+            if session.can_accept():
+               group.next_member = (group.next_member + i + 1) % len(group.members)
+               topic, payload, pub_qos = group.pending.pop(0)
+               session.deliver(topic, payload, min(qos, pub_qos), group)
+               if self.on_deliver:
+                  self.on_deliver(session.client_id, topic, payload, time())
+               break
+         else:
+            return # every member is at its receive maximum, wait for a PUBACK
+
+   def route(self, topic:str, payload:bytes, qos:int) -> None:
+      for session in list(self.sessions.values()):
+         for topic_filter, sub_qos in session.subscriptions.items():
+            if topic_matches(topic_filter, topic):
+               session.deliver(topic, payload, min(qos, sub_qos))
+               if self.on_deliver:
+                  self.on_deliver(session.client_id, topic, payload, time())
+               break
+      for (name, topic_filter), group in self.groups.items():
+         if topic_matches(topic_filter, topic):
+            group.pending.append((topic, payload, qos))
+            self.dispatch_group(group)
+
+   def drop_session(self, session:Session) -> None:
+      if self.sessions.get(session.client_id) is session:
+         del self.sessions[session.client_id]
+      for group in self.groups.values():
+         group.members = [(s, q) for s, q in group.members if s is not session]
+      # unacknowledged shared messages go back to their group for another member
+      for pid, (topic, payload, group) in session.inflight.items():
+         if group is not None:
+            group.pending.insert(0, (topic, payload, 1))
+      session.inflight.clear()
+      for group in self.groups.values():
+         self.dispatch_group(group)
+
+   async def read_packet(self, reader) -> tuple:
+      first = await reader.readexactly(1)
+      mult, length = 1, 0
+      while True:
+         b = (await reader.readexactly(1))[0]
+         length += (b & 0x7F) * mult
+         if b & 0x80 == 0:
+            break
+         mult *= 128
+      body = await reader.readexactly(length) if length > 0 else b''
+      return (first[0] >> 4, first[0] & 0x0F, body)
+
+   async def handle(self, reader, writer) -> None:
+      session = None
+      try:
+         while True:
+            ptype, flags, body = await self.read_packet(reader)
+            if ptype == CONNECT:
+               idx = decode_string(body, 0)[1] + 1 # protocol name and level
+               idx += 3 # connect flags and keep alive
+               props, idx = decode_properties(body, idx)
+               client_id, idx = decode_string(body, idx)
+               client_id = client_id or f"anon-{id(writer)}"
+               if client_id in self.sessions:
+                  self.drop_session(self.sessions[client_id])
+               session = Session(client_id, writer, props.get(RECEIVE_MAXIMUM, 65535))
+               self.sessions[client_id] = session
+               # session present 0, success, properties: shared subscriptions available
+               session.send(packet(CONNACK, 0, bytes([0, 0]) + encode_varint(2) + bytes([0x2A, 1])))
+            elif session is None:
+               break
+            elif ptype == PUBLISH:
+               qos = (flags >> 1) & 3
+               topic, idx = decode_string(body, 0)
+               if qos > 0:
+                  pid = struct.unpack_from('!H', body, idx)[0]
+                  idx += 2
+               props, idx = decode_properties(body, idx)
+               payload = body[idx:]
+               if self.on_publish:
+                  self.on_publish(session.client_id, topic, payload, time())
+               self.route(topic, payload, qos)
+               if qos > 0:
+                  session.send(packet(PUBACK, 0, struct.pack('!H', pid)))
+            elif ptype == PUBACK:
+               pid = struct.unpack_from('!H', body, 0)[0]
+               topic, payload, group = session.inflight.pop(pid, (None, None, None))
+               if group is not None:
+                  self.dispatch_group(group)
+            elif ptype == SUBSCRIBE:
+               pid = struct.unpack_from('!H', body, 0)[0]
+               props, idx = decode_properties(body, 2)
+               granted = []
+               while idx < len(body):
+                  topic_filter, idx = decode_string(body, idx)
+                  qos = body[idx] & 3
+                  idx += 1
+                  if topic_filter.startswith('$share/'):
+                     name, shared_filter = topic_filter[len('$share/'):].split('/', 1)
+                     group = self.groups.setdefault((name, shared_filter), SharedGroup())
+                     group.members.append((session, qos))
+                     self.dispatch_group(group)
+                  else:
+                     session.subscriptions[topic_filter] = qos
+                  granted.append(min(qos, 1))
+               session.send(packet(SUBACK, 0, struct.pack('!H', pid) + encode_varint(0) + bytes(granted)))
+            elif ptype == UNSUBSCRIBE:
+               pid = struct.unpack_from('!H', body, 0)[0]
+               props, idx = decode_properties(body, 2)
+               codes = []
+               while idx < len(body):
+                  topic_filter, idx = decode_string(body, idx)
+                  session.subscriptions.pop(topic_filter, None)
+                  codes.append(0)
+               session.send(packet(UNSUBACK, 0, struct.pack('!H', pid) + encode_varint(0) + bytes(codes)))
+            elif ptype == PINGREQ:
+               session.send(packet(PINGRESP, 0, b''))
+            elif ptype == DISCONNECT:
+               break
+            await writer.drain()
+      except (asyncio.IncompleteReadError, ConnectionError):
+         pass
+      finally:
+         if session is not None:
+            self.drop_session(session)
+         writer.close()
+
+def publish_once(host:str, port:int, topic:str, payload:bytes, client_id:str='bench-publish') -> None:
+   # blocking QoS 0 publish for the fake tools, which have no event loop of their own
+   with socket.create_connection((host, port)) as sock:
+      connect = encode_string("MQTT") + bytes([5, 0x02]) + struct.pack('!H', 60) + encode_varint(0) + encode_string(client_id)
+      sock.sendall(packet(CONNECT, 0, connect))
+      sock.recv(64) # CONNACK
+      sock.sendall(packet(PUBLISH, 0, encode_string(topic) + encode_varint(0) + payload))
+      sock.sendall(packet(DISCONNECT, 0, b''))
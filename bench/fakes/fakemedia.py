@@ -0,0 +1,33 @@
+# shared by the fake tools: a synthetic recording is a JSON header line describing the media, padded out to its catalog size
+import os
+import json
+
+HEADER_BYTES = 4096
+
+def env_float(name:str, default:float) -> float:
+   return float(os.environ.get(name, default))
+
+def load_catalog() -> list:
+   with open(os.environ['BENCH_CATALOG']) as fp:
+      return json.load(fp)
+
+def find_recording(path:str) -> dict:
+   base = os.path.basename(path.strip("'\""))
+   for r in load_catalog():
+      if os.path.basename(r['filename']) == base:
+         return r
+   return None
+
+def media_header(media:dict) -> bytes:
+   h = (json.dumps(media) + "\n").encode('utf-8')
+   assert len(h) <= HEADER_BYTES
+   return h + b' ' * (HEADER_BYTES - len(h))
+
+def header(r:dict) -> bytes:
+   return media_header(r['media'])
+
+def read_header(fp) -> dict:
+   return json.loads(fp.read(HEADER_BYTES).decode('utf-8'))
+
+def recording_size(r:dict) -> int:
+   return int(r['size_mb'] * 1024 * 1024)
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+# usage:
+#   python3 bench/run-benchmark.py --workers 1,2,4 --recordings 20 --worker-args="--slots 2"
+# runs video-source-job-publisher.py and N copies of run-rkmppenc.py end-to-end against an in-process MQTT v5 broker,
+# with fake ssh/ffprobe/ffmpeg/rkmppenc (see bench/fakes) serving a synthetic catalog of recordings, then reports
+# throughput, per-stage latency and worker idle time for each worker count
+import os
+import sys
+import json
+import shlex
+import random
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+from time import sleep, time
+from broker import Broker
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FAKES_DIR = os.path.join(BENCH_DIR, 'fakes')
+
+# (width, height, field order, frame rate, crop) typical of the channels we record
+PROFILES = [
+   (720, 576, 'tb', 25, [0, 72, 0, 72]),
+   (1920, 1080, 'tb', 25, [0, 0, 0, 0]),
+   (1280, 720, 'progressive', 50, [0, 0, 0, 0]),
+   (720, 576, 'progressive', 25, [8, 0, 8, 0]),
+]
+
+def make_catalog(n:int, seed:int, size_mb:tuple, minutes:tuple) -> list:
+   rnd = random.Random(seed)
+   catalog = []
+   for i in range(n):
+      width, height, field_order, frame_rate, crop = rnd.choice(PROFILES)
+      duration = rnd.randint(minutes[0], minutes[1]) * 60
+      uuid = f"{rnd.getrandbits(128):032x}"
+      filename = f"/home/hts/recordings/bench-{i:04d}.ts"
+      size = rnd.uniform(size_mb[0], size_mb[1])
+      catalog.append({
+         "filename": filename,
+         "size_mb": size,
+         "media": { "codec": "mpeg2video", "width": width, "height": height, "field_order": field_order, "frame_rate": frame_rate,
+                    "duration": duration, "size": int(size * 1024 * 1024), "crop": crop },
+         "entry": { "uuid": uuid, "status": "Completed OK", "title": { "eng": f"Bench Show {i}" }, "channelname": rnd.choice(["ABC TV", "9Gem", "SBS"]),
+                    "episode_disp": f"Season 1.Episode {i + 1}", "copyright_year": 0, "start": 1700000000 + i * 3600, "stop": 1700000000 + i * 3600 + duration }
+      })
+   return catalog
+
+def job_key(job:dict) -> str:
+   # as run-rkmppenc.py job_id(), so that each segment of a split recording is waited for
+   if 'segment' in job:
+      return f"{job.get('uuid')}/{job['segment']['index']}"
+   return job.get('uuid')
+
+def percentile(values:list, p:float) -> float:
+   if not any(values):
+      return 0.0
+   values = sorted(values)
+   return values[min(len(values) - 1, int(p * len(values)))]
+
+class Observer:
+   # collects what the broker sees: job publishes, job deliveries, worker heartbeats and results
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.published = {} # job key -> time job published on video/mpp
+      self.delivered = {} # job key -> time first delivered to a worker
+      self.results = [] # result records from the workers
+      self.slots = {} # worker -> slots from heartbeats
+
+   def on_publish(self, client_id, topic, payload, t):
+      try:
+         d = json.loads(payload)
+      except ValueError:
+         return
+      with self.lock:
+         if topic == 'video/mpp':
+            self.published.setdefault(job_key(d), t)
+         elif topic.endswith('/result'):
+            self.results.append(d)
+         elif topic.endswith('/heartbeat'):
+            self.slots[d['worker']] = d.get('slots', 1)
+
+   def on_deliver(self, client_id, topic, payload, t):
+      # with --dispatch the job reaches a worker on video/mpp/worker/<worker>, having first been delivered to the dispatcher
+      if topic != 'video/mpp' and not topic.startswith('video/mpp/worker/'):
+         return
+      try:
+         d = json.loads(payload)
+      except ValueError:
+         return
+      with self.lock:
+         if topic == 'video/mpp':
+            self.delivered.setdefault(job_key(d), t)
+         else:
+            self.delivered[job_key(d)] = t
+
+def run_once(n_workers:int, catalog:list, args) -> dict:
+   work_dir = tempfile.mkdtemp(prefix=f"bench-{n_workers}w-")
+   catalog_file = os.path.join(work_dir, 'catalog.json')
+   with open(catalog_file, 'w') as fp:
+      json.dump(catalog, fp)
+   observer = Observer()
+   broker = Broker(on_publish=observer.on_publish, on_deliver=observer.on_deliver)
+   port = broker.start()
+   env = dict(os.environ, PATH=f"{FAKES_DIR}{os.pathsep}{os.environ['PATH']}", BENCH_CATALOG=catalog_file, BENCH_BROKER_PORT=str(port),
+              BENCH_NET_MBPS=str(args.net_mbps), BENCH_ENCODE_FPS=str(args.encode_fps), BENCH_TIME_SCALE=str(args.time_scale),
+              BENCH_SSH_LATENCY=str(args.ssh_latency), BENCH_PROBE_SECONDS=str(args.probe_seconds), PYTHONUNBUFFERED='1')
+   mqtt_args = ["--mqtt-broker", "127.0.0.1", "--mqtt-port", str(port), "--cafile", ""]
+   nfs = os.path.join(work_dir, 'nfs')
+   os.makedirs(nfs)
+   workers = []
+   if args.dispatch:
+      ddir = os.path.join(work_dir, 'dispatcher')
+      os.makedirs(ddir)
+      cmd = [sys.executable, os.path.join(REPO_DIR, 'job-dispatcher.py')] + mqtt_args + ["--heartbeat-interval", "5", "--interval", "10", "--policy", args.dispatch]
+      workers.append(subprocess.Popen(cmd, cwd=ddir, env=env, stdout=open(os.path.join(ddir, 'log.txt'), 'w'), stderr=subprocess.STDOUT))
+   for i in range(n_workers):
+      wdir = os.path.join(work_dir, f"worker{i}")
+      os.makedirs(wdir)
+      cmd = [sys.executable, os.path.join(REPO_DIR, 'run-rkmppenc.py')] + mqtt_args + ["--scratch-dir", wdir, "--dest-folder", nfs, "--heartbeat-interval", "5", "--trace-file", os.path.join(wdir, 'trace.jsonl')] + (["--dispatched"] if args.dispatch else []) + shlex.split(args.worker_args)
+      workers.append(subprocess.Popen(cmd, cwd=wdir, env=env, stdout=open(os.path.join(wdir, 'log.txt'), 'w'), stderr=subprocess.STDOUT))
+   sleep(2) # let the workers subscribe before any job is published
+   pdir = os.path.join(work_dir, 'publisher')
+   os.makedirs(pdir)
+   cmd = [sys.executable, os.path.join(REPO_DIR, 'video-source-job-publisher.py')] + mqtt_args + ["--ssh-host", args.hosts, "--crop-review", "never", "--scratch-dir", pdir, "--trace-file", os.path.join(pdir, 'trace.jsonl')] + shlex.split(args.publisher_args)
+   t0 = time()
+   publisher = subprocess.Popen(cmd, cwd=pdir, env=env, stdout=open(os.path.join(pdir, 'log.txt'), 'w'), stderr=subprocess.STDOUT)
+   timed_out = False
+   while True:
+      sleep(1)
+      with observer.lock:
+         finished = publisher.poll() is not None and len(observer.results) >= len(observer.published)
+      if finished:
+         break
+      if time() - t0 > args.timeout:
+         timed_out = True
+         break
+   t_end = time()
+   for p in workers + [publisher]:
+      if p.poll() is None:
+         p.send_signal(signal.SIGINT)
+   for p in workers + [publisher]:
+      try:
+         p.wait(timeout=30)
+      except subprocess.TimeoutExpired:
+         p.kill()
+   broker.stop()
+
+   with observer.lock:
+      results = list(observer.results)
+      published = dict(observer.published)
+      delivered = dict(observer.delivered)
+      slots = dict(observer.slots)
+   ok = [r for r in results if r.get('exit_status') == 0]
+   last_finish = max([r['started'] + r['wall_time'] for r in results], default=t_end)
+   span = max(1e-6, last_finish - t0)
+   stages = { "publish": [], "broker_wait": [], "fetch": [], "encode": [], "total": [] }
+   for r in results:
+      uuid = r.get('job_id')
+      if uuid in published:
+         stages['publish'].append(published[uuid] - t0)
+         if uuid in delivered:
+            stages['broker_wait'].append(delivered[uuid] - published[uuid])
+            stages['fetch'].append(r['started'] - delivered[uuid])
+      stages['encode'].append(r['wall_time'])
+      stages['total'].append(r['started'] + r['wall_time'] - t0)
+   idle = {}
+   for worker, n_slots in slots.items():
+      busy = sum(r['wall_time'] for r in results if r['worker'] == worker)
+      idle[worker] = max(0.0, 1.0 - busy / (span * n_slots))
+   return { "workers": n_workers, "jobs": len(ok), "failed": len(results) - len(ok), "published": len(published), "timed_out": timed_out,
+            "span": span, "jobs_per_hour": len(ok) / span * 3600, "stages": stages, "idle": idle, "work_dir": work_dir }
+
+def report(run:dict) -> None:
+   print(f"--- {run['workers']} worker(s): {run['jobs']} ok / {run['failed']} failed of {run['published']} published in {run['span']:.1f}s "
+         f"= {run['jobs_per_hour']:.0f} jobs/hour{' (TIMED OUT)' if run['timed_out'] else ''}   logs: {run['work_dir']}")
+   for stage, values in run['stages'].items():
+      print(f"    {stage:12s} p50 {percentile(values, 0.5):7.2f}s  p90 {percentile(values, 0.9):7.2f}s  max {max(values, default=0):7.2f}s")
+   for worker, fraction in sorted(run['idle'].items()):
+      print(f"    idle {worker}: {100 * fraction:.0f}%")
+   print(f"    per-stage traces: python3 trace-report.py '{run['work_dir']}/*/trace.jsonl'")
+
+if __name__ == "__main__":
+   a = argparse.ArgumentParser(description="End-to-end throughput benchmark of the publisher and rkmppenc workers using local stand-ins")
+   a.add_argument("--workers", help="Comma separated worker counts to benchmark [1,2] ", type=str, default="1,2")
+   a.add_argument("--recordings", help="Number of synthetic recordings in the catalog [12] ", type=int, default=12)
+   a.add_argument("--seed", help="Random seed for the catalog [1] ", type=int, default=1)
+   a.add_argument("--size-mb", help="Range of recording sizes in MB [20:80] ", type=str, default="20:80")
+   a.add_argument("--minutes", help="Range of recording durations in minutes [20:180] ", type=str, default="20:180")
+   a.add_argument("--hosts", help="Source hosts passed to the publisher via --ssh-host [bench-src] ", type=str, default="bench-src")
+   a.add_argument("--net-mbps", help="Fake ssh transfer rate in MB/s [50] ", type=float, default=50)
+   a.add_argument("--ssh-latency", help="Fake ssh connection latency in seconds [0.05] ", type=float, default=0.05)
+   a.add_argument("--probe-seconds", help="Fake ffprobe run time in seconds [0.5] ", type=float, default=0.5)
+   a.add_argument("--encode-fps", help="Fake rkmppenc encode speed in frames per (scaled) second [250] ", type=float, default=250)
+   a.add_argument("--time-scale", help="Multiplier applied to fake encode times [0.01] ", type=float, default=0.01)
+   a.add_argument("--worker-args", help="Extra arguments for each run-rkmppenc.py [] ", type=str, default="")
+   a.add_argument("--publisher-args", help="Extra arguments for video-source-job-publisher.py [] ", type=str, default="")
+   a.add_argument("--dispatch", help="Run job-dispatcher.py with this policy (longest or shortest) in front of the workers, rather than broker round-robin [] ", type=str, choices=['longest', 'shortest'], default=None)
+   a.add_argument("--timeout", help="Seconds to allow each run [600] ", type=int, default=600)
+   args = a.parse_args()
+   catalog = make_catalog(args.recordings, args.seed, tuple(float(i) for i in args.size_mb.split(':')), tuple(int(i) for i in args.minutes.split(':')))
+   runs = [run_once(int(n), catalog, args) for n in args.workers.split(',')]
+   for run in runs:
+      report(run)
+   exit(0)
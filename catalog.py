@@ -0,0 +1,49 @@
+# parsing of tvheadend-mqtt 'publish finished' messages for video-source-job-publisher.py. The message lists every finished
+# recording on the server, so entries are decoded one at a time and those older than the host's high-water mark dropped early
+import json
+import re
+
+WHITESPACE_RE = re.compile(r'[ \t\r\n]*')
+SEPARATOR_RE = re.compile(r'[ \t\r\n,]*')
+
+def entries_start(s:str, decoder:json.JSONDecoder) -> int:
+   # offset just after the '[' of the top-level 'entries' key. Other top-level values are skipped with raw_decode, so
+   # an 'entries' key nested inside them is never mistaken for it
+   idx = WHITESPACE_RE.match(s).end()
+   if s[idx:idx + 1] != '{':
+      raise ValueError("message is not an object")
+   idx += 1
+   while True:
+      idx = SEPARATOR_RE.match(s, idx).end()
+      if s[idx:idx + 1] in ('}', ''):
+         raise ValueError("message has no entries list")
+      key, idx = decoder.raw_decode(s, idx)
+      idx = WHITESPACE_RE.match(s, idx).end()
+      if s[idx:idx + 1] != ':':
+         raise ValueError("malformed message")
+      idx = WHITESPACE_RE.match(s, idx + 1).end()
+      if key == 'entries' and s[idx:idx + 1] == '[':
+         return idx + 1
+      value, idx = decoder.raw_decode(s, idx)
+
+def iter_entries(payload:bytes):
+   # yields each element of the top-level 'entries' array, decoded one at a time by raw_decode rather than building
+   # the whole list
+   s = payload.decode('utf-8') if isinstance(payload, (bytes, bytearray)) else payload
+   decoder = json.JSONDecoder(strict=False)
+   idx = entries_start(s, decoder)
+   while True:
+      idx = SEPARATOR_RE.match(s, idx).end()
+      if idx >= len(s):
+         raise ValueError("truncated entries list")
+      if s[idx] == ']':
+         return
+      e, idx = decoder.raw_decode(s, idx)
+      yield e
+
+def entry_stop(e:dict) -> float:
+   # actual stop time if tvheadend recorded it, else the scheduled one
+   try:
+      return float(e.get('stop_real') or e.get('stop') or 0)
+   except (TypeError, ValueError):
+      return 0.0
@@ -0,0 +1,50 @@
+# automatic black border detection for video-source-job-publisher.py, replacing the manual HandBrake step where possible:
+# ffmpeg cropdetect is run on K short samples spread across the recording (in parallel) and the results combined
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from statistics import median
+
+MIN_SAMPLES = 3 # fewer usable samples than this (eg. unknown duration) is never a consensus
+
+def sample_times(duration:float, samples:int) -> list:
+   # keep clear of the first/last 10% which are often black fades, logos or adverts
+   if duration is None or duration <= 0:
+      return [0.0]
+   start = duration * 0.1
+   span = duration * 0.8
+   return [start + span * (i + 0.5) / samples for i in range(samples)]
+
+def detect_crop_at(local_file:str, offset:float, width:int, height:int, frames:int=50) -> tuple:
+   # returns (left, top, right, bottom) in the same order as the operator prompts, or None if ffmpeg found nothing
+   ffmpeg_args = ["ffmpeg", "-hide_banner", "-nostats", "-ss", f"{offset:.1f}", "-i", local_file, "-an", "-sn", "-frames:v", str(frames), "-vf", "cropdetect=limit=24:round=2:reset=0", "-f", "null", "-"]
+   results = subprocess.run(ffmpeg_args, capture_output=True)
+   if results.returncode != 0:
+      return None
+   crops = re.findall(r"crop=(\d+):(\d+):(\d+):(\d+)", results.stderr.decode('utf-8', errors='replace'))
+   if not any(crops):
+      return None
+   w, h, x, y = [int(i) for i in crops[-1]]
+   return (x, y, width - w - x, height - h - y)
+
+def consensus(crops:list, tolerance:int) -> tuple:
+   # per-edge median is robust to the odd dark scene; the samples agree if most of them lie within tolerance of it
+   crops = [c for c in crops if c is not None]
+   if not any(crops):
+      return (None, False)
+   if len(crops) < MIN_SAMPLES:
+      return (crops[0], False)
+   result = tuple(int(median([c[edge] for c in crops])) for edge in range(4))
+   agreeing = [c for c in crops if all(abs(c[edge] - result[edge]) <= tolerance for edge in range(4))]
+   return (result, len(agreeing) * 4 >= len(crops) * 3)
+
+def detect_crop(local_file:str, media_info:dict, samples:int=8, workers:int=4, tolerance:int=8) -> tuple:
+   # returns (crop, agreed) where crop is (left, top, right, bottom) or None if it could not be determined
+   if not media_info or not media_info.get('width') or not media_info.get('height'):
+      return (None, False)
+   offsets = sample_times(media_info.get('duration'), samples)
+   # threads are enough, each just waits on its ffmpeg process
+   with ThreadPoolExecutor(max_workers=workers) as pool:
+      crops = list(pool.map(detect_crop_at, [local_file] * len(offsets), offsets, [media_info['width']] * len(offsets), [media_info['height']] * len(offsets)))
+   print(f"Crop samples for {local_file}: {crops}")
+   return consensus(crops, tolerance)
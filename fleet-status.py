@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# usage:
+#   python3 fleet-status.py --status-topic video/status
+# collects heartbeats and job results published by each run-rkmppenc.py and periodically prints fleet throughput
+import os
+import json
+import argparse
+from time import sleep, time
+from statistics import median
+import paho.mqtt.client as mqtt
+import threading
+
+done = False
+status_lock = threading.Lock()
+heartbeats = {} # worker -> latest heartbeat
+results = [] # job results finished within the window, oldest first
+window = 3600
+
+def on_message(client, userdata, message):
+   try:
+      d = json.loads(message.payload)
+   except json.decoder.JSONDecodeError:
+      print(f"Encountered invalid JSON on {message.topic} ... ignoring")
+      return
+   if not isinstance(d, dict) or 'worker' not in d:
+      return
+   with status_lock:
+      if message.topic.endswith('/heartbeat'):
+         heartbeats[d['worker']] = d
+      elif message.topic.endswith('/result'):
+         results.append(d)
+         # a long running monitor need only keep what the report looks at
+         cutoff = time() - window
+         results[:] = [r for r in results if r.get('started', 0) + r.get('wall_time', 0) >= cutoff]
+
+def on_connect(client, userdata, flags, reason_code, properties):
+   print(f"Connected with result code {reason_code}")
+   client.subscribe(f"{status_topic}/#", qos=1)
+
+def on_disconnect(client, userdata, flags, rc, props):
+   print(f"Disconnected with result code {rc}... will reconnect")
+
+def worker_fps(worker:str, window_results:list) -> float:
+   # encode speed of one slot over the window: frames encoded per second of wall time for successful jobs
+   frames = sum(r.get('frames') or 0 for r in window_results if r['worker'] == worker and r.get('exit_status') == 0)
+   wall = sum(r.get('wall_time') or 0 for r in window_results if r['worker'] == worker and r.get('exit_status') == 0)
+   return frames / wall if wall > 0 else None
+
+def report(window:int, slow_ratio:float) -> None:
+   now = time()
+   with status_lock:
+      window_results = [r for r in results if r.get('started', 0) + r.get('wall_time', 0) >= now - window]
+      current = dict(heartbeats)
+   hours = window / 3600
+   ok = [r for r in window_results if r.get('exit_status') == 0]
+   print(f"=== fleet status over the last {window}s: {len(ok)} jobs ok, {len(window_results) - len(ok)} failed")
+   print(f"    throughput: {len(ok) / hours:.1f} jobs/hour, {sum(r.get('input_bytes') or 0 for r in ok) / hours / 1e9:.2f} GB/hour in, "
+         f"{sum(r.get('duration') or 0 for r in ok) / hours / 3600:.2f} hours of video/hour")
+   speeds = {}
+   for worker, hb in sorted(current.items()):
+      fps = worker_fps(worker, window_results)
+      if fps is None and any(hb.get('jobs', [])):
+         # per job like worker_fps(), not the board's total across its slots
+         live = [j.get('fps') for j in hb['jobs'] if j.get('fps')]
+         fps = sum(live) / len(live) if any(live) else None
+      if fps is not None:
+         speeds[worker] = fps
+   typical = median(speeds.values()) if any(speeds) else None
+   for worker, hb in sorted(current.items()):
+      age = now - hb.get('time', 0)
+      jobs = ', '.join(f"{j.get('job_id')} {j.get('percent') or 0:.1f}% @ {j.get('fps') or 0:.0f}fps eta {j.get('eta')}s" for j in hb.get('jobs', []))
+      flags = []
+      if age > 3 * heartbeat_interval:
+         flags.append(f"SILENT {age:.0f}s")
+      if hb.get('failed_uploads'):
+         flags.append(f"{hb['failed_uploads']} FAILED UPLOADS held in scratch")
+      if typical and worker in speeds and speeds[worker] < typical * slow_ratio:
+         flags.append(f"SLOW {speeds[worker]:.0f} vs median {typical:.0f} fps")
+      print(f"    {worker}: {hb.get('slots_busy')}/{hb.get('slots')} slots, {hb.get('queued')} queued, "
+            f"{(hb.get('scratch_free') or 0) / 1e9:.1f} GB scratch free {' '.join(flags)} [{jobs}]")
+
+if __name__ == "__main__":
+   a = argparse.ArgumentParser(description="Aggregate run-rkmppenc.py heartbeats and job results into fleet throughput")
+   a.add_argument("--mqtt-broker", help="Hostname of MQTT broker [opi2.lan] ", type=str, default="opi2.lan")
+   a.add_argument('--mqtt-port', help="Port of MQTT broker to user [8883] ", type=int, default=8883)
+   a.add_argument("--status-topic", help="Topic prefix the workers publish status to [video/status] ", type=str, default="video/status")
+   a.add_argument("--cafile", help="Certificate Authority Certificate filename [ca.crt] ", type=str, default="ca.crt")
+   a.add_argument("--cert", help="Host certificate filename [host.crt] ", type=str, default="host.crt")
+   a.add_argument("--key", help="Host private key filename [host.key] ", type=str, default="host.key")
+   a.add_argument("--window", help="Seconds of job results to compute throughput over [3600] ", type=int, default=3600)
+   a.add_argument("--interval", help="Seconds between reports [60] ", type=int, default=60)
+   a.add_argument("--heartbeat-interval", help="Heartbeat interval used by the workers, boards silent for 3x this are flagged [30] ", type=int, default=30)
+   a.add_argument("--slow-ratio", help="Flag boards encoding below this fraction of the fleet median fps per job [0.7] ", type=float, default=0.7)
+   args = a.parse_args()
+   status_topic = args.status_topic
+   heartbeat_interval = args.heartbeat_interval
+   window = args.window
+   client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"fleet-status{os.getpid()}", protocol=mqtt.MQTTv5)
+   client.on_message = on_message
+   client.on_connect = on_connect
+   client.on_disconnect = on_disconnect
+   if args.cafile: # empty for a plain TCP broker eg. the benchmark's stand-in
+      client.tls_set(ca_certs=args.cafile, certfile=args.cert, keyfile=args.key)
+   client.connect(args.mqtt_broker, port=args.mqtt_port)
+   client.loop_start()
+   try:
+      while not done:
+         sleep(args.interval)
+         report(args.window, args.slow_ratio)
+   except KeyboardInterrupt:
+      pass
+   client.loop_stop()
+   exit(0)
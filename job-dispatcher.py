@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+# usage:
+#   python3 job-dispatcher.py --policy longest
+# takes jobs from the shared video/mpp topic in place of the workers and assigns each to a board via its own topic
+# (run-rkmppenc.py --dispatched), using the job cost estimated by the publisher and the capacity each worker advertises
+# in its heartbeat. Original job messages are only acknowledged once the assigned worker reports a result, so jobs held
+# here or on a board that falls silent go back to the broker (or to another board) rather than being lost
+import os
+import json
+import argparse
+from time import sleep, time
+import paho.mqtt.client as mqtt
+from paho.mqtt.enums import MQTTErrorCode
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+import threading
+from mediainfo import job_cost as estimate_job_cost
+
+done = False
+jobs_topic = None # non-shared form of --mqtt-topic, workers are sent jobs on <jobs_topic>/worker/<worker>
+status_topic = None
+policy = 'longest'
+silent_after = 90
+state_lock = threading.Lock() # callbacks run on the paho network thread, the main loop reschedules periodically
+pending = [] # (cost, job key, message, connection) not yet assigned
+job_info = {} # job key -> (priority, duration) until the job is finished
+workers = {} # worker -> { capacity, accepts, reserved, reserve_seconds, time, progress: {job key: percent}, assigned: {job key: (cost, message, connection, time)} }
+connection = 0 # bumped on every (re)connect, message ids are only valid on the connection they arrived on
+
+def job_key(job:dict) -> str:
+   # same as run-rkmppenc.py job_id(), which the workers report results against
+   if 'segment' in job:
+      return f"{job.get('uuid')}/{job['segment']['index']}"
+   return job.get('uuid') or job.get('preferred_output_filename')
+
+def job_cost(job:dict) -> float:
+   # jobs from an older publisher carry no cost, estimate it from what they do carry
+   return job.get('cost') or estimate_job_cost(job) or 1.0
+
+def ack_job(client, message, received:int) -> None:
+   if received != connection:
+      # the broker requeued it when that connection dropped, a redelivery (if any) replaces it, see redelivered()
+      print(f"Not acknowledging message {message.mid} from an earlier connection")
+      return
+   client.ack(message.mid, message.qos)
+
+def redelivered(key:str, message) -> bool:
+   # a job already held eg. resent by the broker after a reconnect: keep its place (and its worker), but take the
+   # new message as only that one can be acknowledged now. A different payload under the same key is a new attempt
+   # eg. a failed segment republished by a worker
+   for i, (cost, pending_key, old, received) in enumerate(pending):
+      if pending_key == key and old.payload == message.payload:
+         pending[i] = (cost, key, message, connection)
+         return True
+   for worker, w in workers.items():
+      if key in w['assigned'] and w['assigned'][key][1].payload == message.payload:
+         cost, old, received, assigned = w['assigned'][key]
+         w['assigned'][key] = (cost, message, connection, assigned)
+         return True
+   return False
+
+def on_message(client, userdata, message):
+   received = connection
+   try:
+      d = json.loads(message.payload, strict=False)
+   except json.decoder.JSONDecodeError:
+      print(f"Encountered invalid JSON on {message.topic} ... ignoring")
+      ack_job(client, message, received)
+      return
+   if not isinstance(d, dict):
+      ack_job(client, message, received)
+      return
+   with state_lock:
+      if message.topic == jobs_topic and redelivered(job_key(d), message):
+         print(f"Job {job_key(d)} redelivered, already held")
+      elif message.topic == jobs_topic:
+         pending.append((job_cost(d), job_key(d), message, received))
+         job_info[job_key(d)] = (d.get('priority') or 0, (d.get('media_info') or {}).get('duration'))
+         print(f"Queued job {job_key(d)} cost {job_cost(d)}, {len(pending)} pending")
+      elif message.topic.endswith('/heartbeat') and 'worker' in d:
+         w = workers.setdefault(d['worker'], { "assigned": {} })
+         w.update(capacity=d.get('capacity') or 1.0, accepts=d.get('accepts') or d.get('slots') or 1, time=time(),
+                  reserved=d.get('reserved') or 0, reserve_seconds=d.get('reserve_seconds') or 0,
+                  progress={ j.get('job_id'): j.get('percent') or 0 for j in d.get('jobs', []) })
+      elif message.topic.endswith('/result') and 'worker' in d:
+         finished(client, d)
+      schedule(client)
+   if message.topic != jobs_topic and message.qos > 0:
+      ack_job(client, message, received)
+
+def finished(client, result:dict) -> None:
+   # acknowledge the original job, whichever worker ended up doing it
+   for worker, w in workers.items():
+      job = w['assigned'].pop(result.get('job_id'), None)
+      if job is not None:
+         cost, message, received, assigned = job
+         job_info.pop(result.get('job_id'), None)
+         print(f"{result['worker']} finished {result.get('job_id')} (exit status {result.get('exit_status')}) in {result.get('wall_time', 0):.0f}s")
+         ack_job(client, message, received)
+         return
+
+def remaining_cost(w:dict) -> float:
+   return sum(cost * (1 - (w['progress'].get(key) or 0) / 100) for key, (cost, message, received, assigned) in w['assigned'].items())
+
+def finish_time(w:dict, extra_cost:float=0) -> float:
+   # seconds until the worker would be through everything assigned to it
+   return (remaining_cost(w) + extra_cost) / max(w['capacity'], 1e-6)
+
+def reclaim_silent(now:float) -> None:
+   for worker, w in workers.items():
+      if now - w['time'] > silent_after and any(w['assigned']):
+         print(f"{worker} silent for {now - w['time']:.0f}s... reassigning {list(w['assigned'])}")
+         for key, (cost, message, received, assigned) in w['assigned'].items():
+            pending.append((cost, key, message, received))
+         w['assigned'] = {}
+
+def can_take(w:dict, key:str) -> bool:
+   # a worker running --reserve-slot keeps room for short or priority jobs, other jobs may only fill the rest
+   if len(w['assigned']) >= w['accepts']:
+      return False
+   priority, duration = job_info.get(key, (0, None))
+   if priority > 0 or (duration is not None and duration <= w.get('reserve_seconds', 0)):
+      return True
+   return len(w['assigned']) < w['accepts'] - w.get('reserved', 0)
+
+def schedule(client) -> None:
+   # list scheduling: take jobs highest priority first, then longest (or shortest) first, and give each to the board
+   # which would finish it soonest. Boards are only sent as many jobs as they can hold, so the remainder can still go
+   # to whichever board frees up first
+   now = time()
+   reclaim_silent(now)
+   pending.sort(key=lambda p: (-job_info.get(p[1], (0, None))[0], -p[0] if policy == 'longest' else p[0]))
+   for cost, key, message, received in list(pending):
+      if not any(now - w['time'] <= silent_after and len(w['assigned']) < w['accepts'] for w in workers.values()):
+         return
+      live = [(worker, w) for worker, w in workers.items() if now - w['time'] <= silent_after and can_take(w, key)]
+      if not any(live):
+         continue # a later short job may still fit a reserved slot
+      worker, w = min(live, key=lambda item: finish_time(item[1], cost))
+      ret = client.publish(f"{jobs_topic}/worker/{worker}", message.payload, qos=1)
+      # whilst disconnected paho queues the publish and sends it on reconnect, so the job is assigned all the same
+      if ret[0] not in (MQTTErrorCode.MQTT_ERR_SUCCESS, MQTTErrorCode.MQTT_ERR_NO_CONN):
+         print(f"Unable to send {key} to {worker}: {ret}")
+         return
+      pending.remove((cost, key, message, received))
+      w['assigned'][key] = (cost, message, received, now)
+      print(f"Assigned {key} (cost {cost}) to {worker}, estimated to finish its work in {finish_time(w):.0f}s")
+
+def report(client) -> None:
+   now = time()
+   with state_lock:
+      plan = { worker: (len(w['assigned']), finish_time(w)) for worker, w in workers.items() if now - w['time'] <= silent_after }
+      backlog = sum(p[0] for p in pending)
+      capacity = sum(w['capacity'] for worker, w in workers.items() if worker in plan)
+      n_pending = len(pending)
+   # lets workers running --profile auto see the jobs still held here when judging how far behind the fleet is
+   client.publish(f"{status_topic}/backlog", json.dumps({ "time": now, "jobs": n_pending, "cost": backlog, "workers": len(plan) }), qos=0)
+   print(f"=== {n_pending} jobs pending (cost {backlog:.0f}), estimated makespan {max([f for n, f in plan.values()], default=0) + backlog / max(capacity, 1e-6):.0f}s")
+   for worker, (n, f) in sorted(plan.items()):
+      print(f"    {worker}: {n} assigned, busy for {f:.0f}s")
+
+def on_connect(client, userdata, flags, reason_code, properties):
+   global connection
+   print(f"Connected with result code {reason_code}")
+   with state_lock:
+      connection += 1
+   t = client.subscribe(args.mqtt_topic, qos=1)
+   assert t[0] == MQTTErrorCode.MQTT_ERR_SUCCESS
+   if args.mqtt_topic.startswith('$'): # shared subscriptions not supported by paho mqtt client
+      client.message_callback_add(jobs_topic, on_message)
+   client.subscribe(f"{status_topic}/+/heartbeat", qos=0)
+   client.subscribe(f"{status_topic}/+/result", qos=1)
+
+def on_disconnect(client, userdata, flags, rc, props):
+   print(f"Disconnected with result code {rc}... will reconnect")
+
+if __name__ == "__main__":
+   a = argparse.ArgumentParser(description="Assign rkmppenc jobs to workers by estimated cost and advertised capacity")
+   a.add_argument("--mqtt-broker", help="Hostname of MQTT broker [opi2.lan] ", type=str, default="opi2.lan")
+   a.add_argument('--mqtt-port', help="Port of MQTT broker to user [8883] ", type=int, default=8883)
+   a.add_argument('--mqtt-topic', help="Topic to read jobs from [$share/dispatcher/video/mpp] ", type=str, default='$share/dispatcher/video/mpp')
+   a.add_argument("--status-topic", help="Topic prefix the workers publish status to [video/status] ", type=str, default="video/status")
+   a.add_argument("--cafile", help="Certificate Authority Certificate filename [ca.crt] ", type=str, default="ca.crt")
+   a.add_argument("--cert", help="Host certificate filename [host.crt] ", type=str, default="host.crt")
+   a.add_argument("--key", help="Host private key filename [host.key] ", type=str, default="host.key")
+   a.add_argument("--policy", help="Order to hand out jobs: longest first minimises the makespan of a backlog, shortest first gets short shows done soonest [longest] ",
+                  type=str, choices=['longest', 'shortest'], default='longest')
+   a.add_argument("--heartbeat-interval", help="Heartbeat interval used by the workers, jobs on boards silent for 3x this are reassigned [30] ", type=int, default=30)
+   a.add_argument("--interval", help="Seconds between schedule reports [60] ", type=int, default=60)
+   args = a.parse_args()
+   jobs_topic = args.mqtt_topic.split('/', 2)[-1] if args.mqtt_topic.startswith('$share/') else args.mqtt_topic
+   status_topic = args.status_topic
+   policy = args.policy
+   silent_after = 3 * args.heartbeat_interval
+   client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"job-dispatcher{os.getpid()}", protocol=mqtt.MQTTv5, manual_ack=True)
+   # the whole backlog must reach us to be ordered, jobs stay unacknowledged until a worker reports them finished
+   connect_properties = Properties(PacketTypes.CONNECT)
+   connect_properties.ReceiveMaximum = 65535
+   client.on_message = on_message
+   client.on_connect = on_connect
+   client.on_disconnect = on_disconnect
+   if args.cafile: # empty for a plain TCP broker eg. the benchmark's stand-in
+      client.tls_set(ca_certs=args.cafile, certfile=args.cert, keyfile=args.key)
+   client.connect(args.mqtt_broker, port=args.mqtt_port, properties=connect_properties)
+   client.loop_start()
+   try:
+      while not done:
+         sleep(args.interval)
+         with state_lock:
+            schedule(client)
+         report(client)
+   except KeyboardInterrupt:
+      pass
+   client.loop_stop()
+   exit(0)
@@ -0,0 +1,135 @@
+# job state for video-source-job-publisher.py: one row per tvheadend recording uuid plus the publisher's probe/crop caches.
+# All writes go through a single writer thread; the uuids which need no further work are held in memory so the
+# MQTT callback can filter an 'entries' message without touching the database
+import json
+import sqlite3
+import threading
+from queue import Queue
+from time import time
+
+STATES = ('seen', 'analysed', 'published', 'failed', 'skipped')
+# recordings in these states are never queued again
+DONE_STATES = ('published', 'skipped')
+
+SCHEMA = [
+   'CREATE TABLE IF NOT EXISTS jobs (uuid TEXT PRIMARY KEY, state TEXT NOT NULL, first_seen REAL NOT NULL, updated REAL NOT NULL, settings TEXT);',
+   'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);',
+   'CREATE TABLE IF NOT EXISTS crop_settings (channelname TEXT, title TEXT, resolution TEXT, crop TEXT, PRIMARY KEY (channelname, title, resolution));',
+   'CREATE TABLE IF NOT EXISTS media_info (uuid TEXT, size INTEGER, mtime INTEGER, info TEXT, PRIMARY KEY (uuid, size, mtime));',
+   'CREATE TABLE IF NOT EXISTS sync_marks (host TEXT PRIMARY KEY, high_water REAL NOT NULL, updated REAL NOT NULL);',
+   'CREATE TABLE IF NOT EXISTS fingerprints (fingerprint TEXT PRIMARY KEY, uuid TEXT NOT NULL, host TEXT, updated REAL NOT NULL);',
+]
+
+class JobStore:
+   def __init__(self, db_file:str):
+      self.db_file = db_file
+      self.local = threading.local() # read connections, one per thread
+      con = sqlite3.connect(db_file)
+      con.execute('PRAGMA journal_mode=WAL;')
+      for stmt in SCHEMA:
+         con.execute(stmt)
+      self.migrate_legacy(con)
+      con.commit()
+      self.lock = threading.Lock() # the sets below are shared by the MQTT callback and the analysis threads
+      self.done_uuids = set()
+      self.unfinished_uuids = set() # seen but not yet done, these are retried even when older than a host's high-water mark
+      for uuid, state in con.execute('SELECT uuid, state FROM jobs;'):
+         (self.done_uuids if state in DONE_STATES else self.unfinished_uuids).add(uuid)
+      self.fingerprints = dict(con.execute('SELECT fingerprint, uuid FROM fingerprints;').fetchall()) # fingerprint -> uuid published with it
+      con.close()
+      print(f"Loaded {len(self.done_uuids)} previously processed recordings from {db_file}")
+      self.writes = Queue()
+      self.writer = threading.Thread(target=self.write_loop, daemon=True)
+      self.writer.start()
+
+   def migrate_legacy(self, con) -> None:
+      # earlier versions kept a single uuid_recordings(uuid) table of processed recordings
+      if con.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'uuid_recordings';").fetchone()[0] > 0:
+         now = time()
+         con.execute("INSERT OR IGNORE INTO jobs (uuid, state, first_seen, updated) SELECT uuid, 'published', ?, ? FROM uuid_recordings;", (now, now))
+
+   def reader(self):
+      con = getattr(self.local, 'con', None)
+      if con is None:
+         con = sqlite3.connect(self.db_file)
+         self.local.con = con
+      return con
+
+   def write_loop(self) -> None:
+      con = sqlite3.connect(self.db_file)
+      stop = False
+      while not stop:
+         batch = [self.writes.get()]
+         while not self.writes.empty(): # group whatever else is waiting into the same transaction
+            batch.append(self.writes.get())
+         stop = None in batch
+         items = [item for item in batch if item is not None]
+         try:
+            with con:
+               for item in items:
+                  con.execute(*item)
+         except sqlite3.Error as e:
+            # one bad statement (or a lock timeout) must not lose the rest of the batch nor stop the writer
+            print(f"Batch of {len(items)} database writes failed ({e})... retrying one at a time")
+            for item in items:
+               try:
+                  with con:
+                     con.execute(*item)
+               except sqlite3.Error as e:
+                  print(f"Dropping database write {item}: {e}")
+         for item in batch:
+            self.writes.task_done()
+      con.close()
+
+   def write(self, sql:str, params) -> None:
+      self.writes.put((sql, params))
+
+   def read_one(self, sql:str, params):
+      return self.reader().execute(sql, params).fetchone()
+
+   def pending_uuids(self, uuids:list) -> set:
+      # batched filter for a whole 'entries' message: uuids not yet done
+      with self.lock:
+         return set(uuids) - self.done_uuids
+
+   def is_unfinished(self, uuid:str) -> bool:
+      with self.lock:
+         return uuid in self.unfinished_uuids
+
+   def set_state(self, uuid:str, state:str, settings:dict=None) -> None:
+      assert state in STATES
+      with self.lock:
+         if state in DONE_STATES:
+            self.done_uuids.add(uuid)
+            self.unfinished_uuids.discard(uuid)
+         else:
+            self.unfinished_uuids.add(uuid)
+      now = time()
+      self.write('INSERT INTO jobs (uuid, state, first_seen, updated, settings) VALUES (?, ?, ?, ?, ?) '
+                 'ON CONFLICT(uuid) DO UPDATE SET state = excluded.state, updated = excluded.updated, settings = COALESCE(excluded.settings, jobs.settings);',
+                 (uuid, state, now, now, json.dumps(settings, sort_keys=True) if settings is not None else None))
+
+   def duplicate_of(self, fingerprint:str, uuid:str) -> str:
+      # uuid of an already processed recording with the same content eg. the same programme recorded on another host
+      with self.lock:
+         other = self.fingerprints.get(fingerprint) if fingerprint else None
+         return other if other != uuid and other in self.done_uuids else None
+
+   def set_fingerprint(self, fingerprint:str, uuid:str, host:str) -> None:
+      with self.lock:
+         self.fingerprints.setdefault(fingerprint, uuid)
+      self.write('INSERT OR IGNORE INTO fingerprints (fingerprint, uuid, host, updated) VALUES (?, ?, ?, ?);', (fingerprint, uuid, host, time()))
+
+   def high_water(self, host:str) -> float:
+      # stop time of the newest recording fully handled for this host, 0 if never synced
+      row = self.read_one('SELECT high_water FROM sync_marks WHERE host = ?;', (host,))
+      return row[0] if row else 0.0
+
+   def set_high_water(self, host:str, high_water:float) -> None:
+      self.write('INSERT INTO sync_marks (host, high_water, updated) VALUES (?, ?, ?) '
+                 'ON CONFLICT(host) DO UPDATE SET high_water = max(high_water, excluded.high_water), updated = excluded.updated;',
+                 (host, high_water, time()))
+
+   def close(self) -> None:
+      self.writes.put(None)
+      self.writer.join()
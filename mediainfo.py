@@ -0,0 +1,75 @@
+# shared by video-source-job-publisher.py and run-rkmppenc.py: a single ffprobe run per recording
+# whose results travel in the job message as the 'media_info' record
+import json
+import subprocess
+
+# bump whenever fields are added/changed so stale records (cached or in-flight jobs) are re-probed
+MEDIA_INFO_VERSION = 1
+
+def parse_rate(rate:str) -> float:
+   # ffprobe reports frame rates as a fraction eg. '25/1' or '30000/1001'
+   try:
+      num, den = rate.split('/')
+      return float(num) / float(den) if float(den) > 0 else None
+   except (ValueError, AttributeError):
+      return None
+
+def probe_media_info(local_file:str) -> dict:
+   ffprobe_results = subprocess.run(["ffprobe", "-v", "quiet", "-print_format", "json", "-show_format", "-show_streams", local_file], capture_output=True)
+   if ffprobe_results.returncode != 0:
+      print(f"Failed to run ffprobe on {local_file} (exit status {ffprobe_results.returncode})")
+      return None
+   try:
+      d = json.loads(ffprobe_results.stdout.decode('utf-8'))
+   except json.decoder.JSONDecodeError:
+      print(f"ffprobe produced invalid JSON for {local_file}... ignoring")
+      return None
+   streams = d.get('streams', [])
+   fmt = d.get('format', {})
+   video = [s for s in streams if s.get('codec_type') == 'video']
+   if not any(video):
+      print(f"No video stream found in {local_file}")
+      return None
+   v = video[0]
+   duration = fmt.get('duration', v.get('duration'))
+   return {
+      "version": MEDIA_INFO_VERSION,
+      "codec": v.get('codec_name'),
+      "width": v.get('width'),
+      "height": v.get('height'),
+      "pix_fmt": v.get('pix_fmt'),
+      "field_order": v.get('field_order', 'unknown'),
+      "frame_rate": parse_rate(v.get('avg_frame_rate')) or parse_rate(v.get('r_frame_rate')),
+      "duration": float(duration) if duration is not None else None,
+      "size": int(fmt['size']) if 'size' in fmt else None,
+      "streams": [{ "index": s.get('index'), "type": s.get('codec_type'), "codec": s.get('codec_name'), "channels": s.get('channels') } for s in streams]
+   }
+
+def valid_media_info(media_info) -> bool:
+   return isinstance(media_info, dict) and media_info.get('version') == MEDIA_INFO_VERSION
+
+def resolution_key(media_info:dict) -> str:
+   # same form as UPSCALE_RES keys eg. '720x576'
+   return f"{media_info['width']}x{media_info['height']}"
+
+# relative encode cost multipliers for the extra rkmppenc work a job asks for
+DEINTERLACE_COST = 1.25
+UPSCALE_COST = 1.6
+
+def estimate_cost(media_info:dict, deinterlace:bool=False, upscale:bool=False) -> float:
+   # encode cost in 1080p frame equivalents (duration x frame rate x resolution), used to schedule jobs across boards
+   if not media_info or not media_info.get('duration'):
+      return None
+   pixels = (media_info.get('width') or 1920) * (media_info.get('height') or 1080)
+   cost = media_info['duration'] * (media_info.get('frame_rate') or 25) * pixels / (1920 * 1080)
+   if deinterlace:
+      cost *= DEINTERLACE_COST
+   if upscale:
+      cost *= UPSCALE_COST
+   return round(cost, 1)
+
+def job_cost(job:dict) -> float:
+   # estimate_cost() for a published job. The worker upscales SD recordings when the job has no explicit output resolution
+   media_info = job.get('media_info')
+   upscale = job.get('output_res') is not None or bool(media_info and (media_info.get('height') or 0) < 720)
+   return estimate_cost(media_info, bool(job.get('interlace_settings')), upscale)
@@ -3,12 +3,24 @@
 import os
 import json
 import argparse
-from time import sleep
+import re
+import shutil
+import signal
+import socket
+from time import sleep, time
 import paho.mqtt.client as mqtt
 from paho.mqtt.enums import MQTTProtocolVersion, MQTTErrorCode
-from queue import Queue, Empty # note: must be thread safe
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+from queue import Queue, PriorityQueue, Empty, Full # note: must be thread safe
+from itertools import count
 import subprocess
-import re
+import tempfile
+import threading
+from mediainfo import probe_media_info, valid_media_info, resolution_key
+from transfer import remote_stat, remote_fingerprint, fetch_file, open_stream, upload_file
+from segments import SEGMENT_RETRIES, segment_folder, mark_part_done, mark_part_failed, concat_segments
+from tracing import open_trace, close_trace, record_span, span
 
 # list of resolutions to perform upscaling on along with corresponding rkmppenc options (if not provided by server-side)
 UPSCALE_RES = {
@@ -16,25 +28,83 @@ UPSCALE_RES = {
   "720x424": ["--output-res", "1222:720,preserve_aspect_ratio=increase"]
 }
 
+# encode profiles, best quality first. vbr of None means the job's own vbr, otherwise it caps the job's vbr. fps is the
+# approximate speed of one slot on an RK3588 by input resolution (refined at runtime from finished jobs), used to estimate
+# how long the backlog will take
+ENCODE_PROFILES = {
+  "best": { "preset": "best", "vbr": None, "upscale": True, "fps": { "720x576": 190, "1280x720": 140, "1920x1080": 75 } },
+  "balanced": { "preset": "balanced", "vbr": None, "upscale": False, "fps": { "720x576": 330, "1280x720": 200, "1920x1080": 105 } },
+  "fast": { "preset": "performance", "vbr": 600, "upscale": False, "fps": { "720x576": 450, "1280x720": 280, "1920x1080": 150 } }
+}
+DEFAULT_VBR = 700
+
 done = False
-work_queue = Queue()
+work_queue = PriorityQueue() # (rank, sequence, recording, delivery), see job_rank(). The job message is acknowledged once the job has finished
+ready_queue = None # (rank, sequence, recording, delivery, local file) fetched ahead of the encoders, bounded by --prefetch. A local file of None means stream the recording
+fast_queue = None # as ready_queue, for jobs the --reserve-slot slot may take. The other slots take these first too
+queue_sequence = count() # keeps jobs of equal priority in arrival order
+short_seconds = 0 # jobs shorter than this (or with a priority) may use the reserved slot
+upload_queue = None # (recording, delivery, local output, result) encoded into scratch with --local-output, waiting to be moved to the destination
+failed_uploads = [] # (recording, delivery, local output, result, failed at) kept in scratch to be uploaded again, guarded by scratch_lock
+UPLOAD_RETRY_INTERVAL = 300 # seconds before a failed upload is tried again
+FAST_QUEUE_SIZE = 1 # jobs prefetched for the --reserve-slot slot
 share_topic = None
+jobs_topic = None # non-shared form of --mqtt-topic, failed segments are republished here
+assign_topic = None # per-worker topic a job-dispatcher.py sends jobs to, instead of the shared topic
+status_topic = None
+scratch_files = set() # every scratch file currently on disk, so they can be removed on shutdown
+scratch_reserved = {} # scratch file -> bytes it was admitted with, counted until it leaves scratch
+scratch_lock = threading.RLock()
+scratch_freed = threading.Condition(scratch_lock) # notified as files leave scratch, for fetches waiting on the budget
+connection = 0 # bumped on every (re)connect, message ids are only valid on the connection they arrived on
+# a job's delivery is { message, connection, and for tracing received_at, ready_at, encoded_at } (paho messages take no
+# extra attributes), passed along with the job
+worker_id = f"{socket.gethostname()}-{os.getpid()}"
+slot_status = {} # slot -> progress of the job it is encoding, reported in heartbeats
+slot_lock = threading.Lock()
+slot_cost_rate = None # job cost encoded per second by one slot, measured from finished jobs (see mediainfo.estimate_cost)
+measured_fps = {} # (profile, resolution) -> fps achieved by one slot, overrides the ENCODE_PROFILES figure
+fleet_backlog = {} # latest backlog reported by job-dispatcher.py: jobs and cost not yet assigned to any worker
+
+# rkmppenc progress lines look like '[45.2%] 12345 frames: 250.12 fps, 712 kb/s, remain 0:03:10, ...' (no percentage when reading a pipe)
+PROGRESS_RE = re.compile(r"(?:\[(\d+(?:\.\d+)?)%\]\s*)?(\d+) frames:\s*(\d+(?:\.\d+)?) fps(?:.*?remain\s+(\d+):(\d+):(\d+))?")
 
 def on_message(client, userdata, message):
    if not message.topic.startswith("$SYS"):
       print(message.topic)
+   delivery = { "message": message, "connection": connection, "received_at": time() }
    try:
-      if 'mpp' in message.topic:
-         work_queue.put(json.loads(message.payload, strict=False))
+      if message.topic == f"{status_topic}/backlog":
+         fleet_backlog.update(json.loads(message.payload))
+      elif 'mpp' in message.topic:
+         r = json.loads(message.payload, strict=False)
+         work_queue.put((job_rank(r), next(queue_sequence), r, delivery))
    except json.decoder.JSONDecodeError:
       print(f"Encountered invalid JSON: {message} ... ignoring")
+      ack_job(client, delivery)
+
+def ack_job(client, delivery:dict) -> None:
+   # manual acks: the broker only sees the job as delivered once we are done with it, so unstarted work stays with the broker
+   message = delivery['message']
+   if delivery['connection'] != connection:
+      # the broker has already requeued it when that connection dropped, the manifest lets a redelivery skip the work
+      print(f"Not acknowledging message {message.mid} from an earlier connection")
+      return
+   client.ack(message.mid, message.qos)
 
 def on_connect(client, userdata, flags, reason_code, properties):
+    global connection
+    connection += 1
     print(f"Connected with result code {reason_code}")
     client.subscribe("$SYS/#")
-    if share_topic:
+    client.subscribe(f"{status_topic}/backlog")
+    if assign_topic:
+       print(f"Subscribing to dispatched jobs topic: {assign_topic}")
+       t = client.subscribe(assign_topic, qos=1)
+       assert t[0] == MQTTErrorCode.MQTT_ERR_SUCCESS
+    elif share_topic:
        print(f"Subscribing to share topic: {share_topic}")
-       t = client.subscribe(share_topic)
+       t = client.subscribe(share_topic, qos=1)
        assert t[0] == MQTTErrorCode.MQTT_ERR_SUCCESS
        if share_topic.startswith('$'): # shared subscriptions not supported by paho mqtt client
           non_shared_topic_filter = share_topic.split('/', maxsplit=1)[-1]
@@ -42,31 +112,243 @@ def on_connect(client, userdata, flags, reason_code, properties):
           client.message_callback_add(non_shared_topic_filter, on_message)
 
 def on_disconnect(client, userdata, flags, rc, props):
-   done = True
+   # paho reconnects by itself (loop_start) and on_connect resubscribes; jobs in hand carry on, only shutdown sets done
+   print(f"Disconnected with result code {rc}... will reconnect")
+
+def new_scratch_file(scratch_dir:str, prefix:str="recording-", suffix:str=".ts", reserve_bytes:int=0) -> str:
+   fd, fname = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=scratch_dir)
+   os.close(fd)
+   with scratch_lock:
+      scratch_files.add(fname)
+      if reserve_bytes > 0:
+         scratch_reserved[fname] = reserve_bytes
+   return fname
 
-def fetch_recording(recording:dict, ssh_user:str, ssh_host:str, folder_prefix:str) -> str:
+def release_scratch_file(fname:str) -> None:
+   with scratch_lock:
+      scratch_files.discard(fname)
+      scratch_reserved.pop(fname, None)
+      try:
+         os.unlink(fname)
+      except FileNotFoundError:
+         pass
+      scratch_freed.notify_all()
+
+def scratch_bytes_used() -> int:
+   total = 0
+   with scratch_lock:
+      for fname in scratch_files:
+         try:
+            size = os.path.getsize(fname)
+         except OSError:
+            size = 0
+         # a fetch just admitted has barely started, count what it will grow to
+         total += max(size, scratch_reserved.get(fname, 0))
+   return total
+
+def recording_path(recording:dict, folder_prefix:str) -> str:
    assert 'recording_file' in recording.keys()
-   rec_basename = os.path.basename(recording['recording_file'])
-   ssh_args = ["scp", f"{ssh_user}@{ssh_host}:{folder_prefix}/{rec_basename}", "recording.ts"]
-   print(f"Fetching recording using: {ssh_args}")
-   ssh_exit_status = subprocess.call(ssh_args)
-   if ssh_exit_status == 0:
-       return "recording.ts"
+   return f"{folder_prefix}/{os.path.basename(recording['recording_file'])}"
+
+def remote_recording_size(recording:dict, ssh_user:str, ssh_host:str, folder_prefix:str) -> int:
+   # the bytes fetch_recording() will download, just its own byte range for a segment
+   if (recording.get('segment') or {}).get('length') is not None:
+      return recording['segment']['length']
+   st = remote_stat(ssh_user, ssh_host, recording_path(recording, folder_prefix))
+   return st[0] if st else 0 # unknown, only the bytes already in scratch will count against the budget
+
+def fetch_recording(recording:dict, ssh_user:str, ssh_host:str, folder_prefix:str, local_fname:str, verify:str='size') -> str:
+   # a segment sub-job only needs its own byte range of the recording
+   segment = recording.get('segment') or {}
+   if fetch_file(ssh_user, ssh_host, recording_path(recording, folder_prefix), local_fname, verify=verify, first_byte=segment.get('first_byte', 0), length=segment.get('length')):
+       return local_fname
+   release_scratch_file(local_fname)
    return None
 
-def compute_upscale_settings(local_file: str) -> list:
-   ffprobe_results = subprocess.run(["ffprobe", "-v", "quiet", "-select_streams", "v", "-show_entries", "stream=codec_name,height,width,pix_fmt,field_order", "-of", "csv=p=0", local_file], capture_output=True)
-   if ffprobe_results.returncode == 0:
-      for line in ffprobe_results.stdout.decode('utf-8').split("\n"):
-         m = re.match(r"^(\S+),(\d+),(\d+),",  line)
-         if m:
-            key = f"{m.group(2)}x{m.group(3)}"
-            if key in UPSCALE_RES:
-               print(f"Upscaling video output as requested for {key}")
-               return UPSCALE_RES[key]
+def open_recording_stream(recording:dict, ssh_user:str, ssh_host:str, folder_prefix:str) -> subprocess.Popen:
+   segment = recording.get('segment') or {}
+   return open_stream(ssh_user, ssh_host, recording_path(recording, folder_prefix), segment.get('first_byte', 0), segment.get('length'))
+
+def can_stream(recording:dict) -> bool:
+   # without an explicit output resolution or media info from the publisher the recording must be probed for upscaling, which needs a seekable local file
+   return recording.get('output_res') is not None or valid_media_info(recording.get('media_info'))
+
+def manifest_path(output_fname:str) -> str:
+   # hidden, so the media library only shows the recording
+   return os.path.join(os.path.dirname(output_fname), f".{os.path.basename(output_fname)}.manifest.json")
+
+def job_settings(recording:dict, whole:bool=False) -> dict:
+   # what must match for an existing output to stand in for this job. whole is for the output joined from all segments
+   settings = { k: recording.get(k) for k in ('crop_settings', 'interlace_settings', 'output_res') }
+   if 'segment' in recording and not whole:
+      settings['segment'] = [recording['segment']['index'], recording['segment']['count']]
+   return settings
+
+def write_manifest(output_fname:str, recording:dict, whole:bool=False) -> None:
+   if not recording.get('fingerprint'):
+      return
+   with open(manifest_path(output_fname), 'w') as fp:
+      json.dump({ "fingerprint": recording['fingerprint'], "uuid": recording.get('uuid'), "settings": job_settings(recording, whole),
+                  "output_bytes": os.path.getsize(output_fname), "worker": worker_id, "time": time() }, fp, sort_keys=True)
+
+def matches_manifest(output_fname:str, recording:dict, fingerprint:str, whole:bool=False) -> bool:
+   try:
+      with open(manifest_path(output_fname)) as fp:
+         manifest = json.load(fp)
+   except (OSError, ValueError):
+      return False
+   return manifest.get('fingerprint') == fingerprint and manifest.get('settings') == job_settings(recording, whole) and \
+          manifest.get('output_bytes') == os.path.getsize(output_fname)
+
+def encoded_output(recording:dict, dest_folder:str) -> str:
+   # an output already encoded from the same content with the same settings, so a redelivered job need not be fetched
+   # or encoded again. For a segment, either its part or the output joined from all parts will do
+   candidates = [(f"{dest_folder}/{recording['preferred_output_filename']}", False)]
+   if 'segment' in recording:
+      candidates.append((f"{dest_folder}/{recording['segment']['output']}", True))
+   candidates = [(fname, whole) for fname, whole in candidates if os.path.exists(fname) and os.path.exists(manifest_path(fname))]
+   if not any(candidates):
+      return None
+   # jobs from an older publisher carry no fingerprint, only worth an ssh round trip when there is an output to compare with
+   fingerprint = recording.get('fingerprint') or remote_fingerprint(recording.get('ssh_user', 'hts'), recording.get('ssh_host', 'opi2.lan'),
+                                                                     recording_path(recording, recording.get('ssh_folder_prefix', 'recordings')))
+   for fname, whole in candidates:
+      if fingerprint and matches_manifest(fname, recording, fingerprint, whole):
+         return fname
+   return None
+
+def wait_for_scratch_budget(scratch_dir:str, needed_bytes:int, budget_bytes:int) -> str:
+   # a new scratch file with needed_bytes reserved for it, so concurrent prefetchers cannot all pass the check before
+   # their fetches grow. None on shutdown. Always permit a fetch when scratch is empty, otherwise a recording larger
+   # than the budget would never run
+   with scratch_freed:
+      while not done:
+         used = scratch_bytes_used()
+         if used == 0 or used + needed_bytes <= budget_bytes:
+            return new_scratch_file(scratch_dir, reserve_bytes=needed_bytes)
+         scratch_freed.wait(timeout=60)
+   return None
+
+def prefetch_recordings(scratch_dir:str, budget_bytes:int, stream_mode:bool=False, verify:str='size', dest_folder:str='/nfs', fast_only:bool=False) -> None:
+   # runs in its own thread: fetches upcoming jobs whilst the encode slots keep rkmppenc busy. With --reserve-slot one
+   # more runs fast_only, so a short job is fetched even when every other prefetcher is holding a film for a full ready_queue
+   while not done:
+      try:
+         priority, sequence, r, delivery = take_job(fast_only)
+      except Empty:
+         continue
+      if not isinstance(r, dict):
+         print(f"ERROR: got recording {r} but not expected JSON type... skipping")
+         fail_unstarted_job(r, delivery, dest_folder, "not a JSON object")
+         continue
+      # published_at is the publisher's clock, received_at ours
+      record_span(r.get('trace_id'), 'broker_wait', r.get('published_at'), delivery['received_at'], **trace_attrs(r))
+      record_span(r.get('trace_id'), 'worker_queue', delivery['received_at'], time(), **trace_attrs(r))
+      existing = encoded_output(r, dest_folder)
+      if existing:
+         print(f"{existing} was already encoded from the same recording with the same settings... skipping {job_id(r)}")
+         record_span(r.get('trace_id'), 'skipped', time(), time(), **trace_attrs(r))
+         finish_job(r, delivery, dest_folder, { "worker": worker_id, "job_id": job_id(r), "exit_status": 0, "skipped": existing, "cost": r.get('cost'),
+                                               "started": time(), "wall_time": 0, "input_bytes": 0, "frames": None,
+                                               "duration": (r.get('media_info') or {}).get('duration') })
+         continue
+      ssh_user = r.get('ssh_user', 'hts')
+      ssh_host = r.get('ssh_host', 'opi2.lan')
+      folder_prefix = r.get('ssh_folder_prefix', 'recordings')
+      if stream_mode and can_stream(r):
+         input_recording_fname = None # main thread will stream it straight into rkmppenc, no scratch needed
+      else:
+         with span(r.get('trace_id'), 'scratch_wait', **trace_attrs(r)):
+            local_fname = wait_for_scratch_budget(scratch_dir, remote_recording_size(r, ssh_user, ssh_host, folder_prefix), budget_bytes)
+         if local_fname is None:
+            break
+         with span(r.get('trace_id'), 'fetch', host=ssh_host, **trace_attrs(r)):
+            input_recording_fname = fetch_recording(r, ssh_user, ssh_host, folder_prefix, local_fname, verify)
+         if not input_recording_fname:
+            print(f"Unable to fetch recording {r}... ignoring but continuing to process remaining recordings")
+            fail_unstarted_job(r, delivery, dest_folder, "fetch failed")
+            continue
+      # a short or priority job goes to the reserved slot's queue, so it need not wait for a film to be taken first
+      target_queue = fast_queue if fast_queue is not None and fast_job(r) else ready_queue
+      queued = False
+      while not queued:
+         if done:
+            if input_recording_fname:
+               release_scratch_file(input_recording_fname)
+            return
+         try:
+            delivery['ready_at'] = time()
+            target_queue.put((priority, sequence, r, delivery, input_recording_fname), block=True, timeout=10)
+            queued = True
+         except Full:
+            pass
+
+def cleanup_scratch() -> None:
+   for q in (ready_queue, fast_queue):
+      while q is not None:
+         try:
+            priority, sequence, r, delivery, fname = q.get(block=False)
+            print(f"Discarding prefetched recording {r} on shutdown... left unacknowledged for redelivery")
+         except Empty:
+            break
+   while upload_queue is not None:
+      try:
+         r, delivery, fname, result = upload_queue.get(block=False)
+         print(f"Discarding encoded {fname} awaiting upload on shutdown... left unacknowledged for redelivery")
+      except Empty:
+         break
+   with scratch_lock:
+      for r, delivery, fname, result, failed_at in failed_uploads:
+         print(f"Discarding encoded {fname} which failed to upload on shutdown... left unacknowledged for redelivery")
+      failed_uploads.clear()
+   with scratch_lock:
+      remaining = list(scratch_files)
+   for fname in remaining:
+      release_scratch_file(fname)
+
+def compute_upscale_settings(media_info:dict) -> list:
+   if media_info:
+      key = resolution_key(media_info)
+      if key in UPSCALE_RES:
+         print(f"Upscaling video output as requested for {key}")
+         return UPSCALE_RES[key]
    return []
  
-def run_transcode(transcode_settings:dict, input_recording_fname=str, dest_folder='/nfs') -> None:
+def parse_progress(line:str, media_info:dict=None) -> dict:
+   m = PROGRESS_RE.search(line)
+   if not m:
+      return None
+   progress = { "frames": int(m.group(2)), "fps": float(m.group(3)), "percent": float(m.group(1)) if m.group(1) else None, "eta": None }
+   if m.group(4):
+      progress['eta'] = int(m.group(4)) * 3600 + int(m.group(5)) * 60 + int(m.group(6))
+   if progress['percent'] is None and media_info and media_info.get('duration') and media_info.get('frame_rate'):
+      # streamed input: rkmppenc cannot tell how long the recording is, but the publisher's probe can
+      total_frames = media_info['duration'] * media_info['frame_rate']
+      progress['percent'] = min(100.0, 100.0 * progress['frames'] / total_frames)
+      if progress['fps'] > 0:
+         progress['eta'] = max(0, int((total_frames - progress['frames']) / progress['fps']))
+   return progress
+
+def watch_progress(stream, media_info:dict=None, on_progress=None) -> None:
+   # rkmppenc rewrites its progress line with '\r', everything else is passed through to our stdout
+   pending = b''
+   for chunk in iter(lambda: stream.read1(4096), b''):
+      pending += chunk
+      lines = re.split(rb'[\r\n]', pending)
+      pending = lines.pop()
+      for line in lines:
+         text = line.decode('utf-8', errors='replace').strip()
+         if not text:
+            continue
+         progress = parse_progress(text, media_info)
+         if progress is None:
+            print(text)
+         elif on_progress:
+            on_progress(progress)
+   if pending.strip():
+      print(pending.decode('utf-8', errors='replace').strip())
+
+def run_transcode(transcode_settings:dict, input_recording_fname=str, dest_folder='/nfs', stdin=None, on_progress=None, profile:dict=ENCODE_PROFILES['best'], output_fname:str=None) -> int:
    assert isinstance(transcode_settings, dict)
    crop_settings = []
    print(transcode_settings)
@@ -86,18 +368,354 @@ def run_transcode(transcode_settings:dict, input_recording_fname=str, dest_folde
        output_settings = ['--output-res', ':'.join([str(i) for i in res])]
    else:
        # upscale_settings must only be set if output_settings is empty
-       upscale_settings.extend(compute_upscale_settings(input_recording_fname))
+       media_info = transcode_settings.get('media_info')
+       if not valid_media_info(media_info) and input_recording_fname != '-':
+          print(f"No usable media info in job... probing {input_recording_fname}")
+          media_info = probe_media_info(input_recording_fname)
+       if profile['upscale']:
+          upscale_settings.extend(compute_upscale_settings(media_info))
         
    # HEVC output with de-interlacing and cropping is not supported currently, so we ensure interlacing is dropped if this is the case
    if any(crop_settings) and interlace_settings is not None and len(interlace_settings) > 0:
        interlace_settings = []
 
+   # a streamed recording has no file extension for rkmppenc to go on
+   input_settings = ["--input-format", "mpegts"] if input_recording_fname == '-' else []
+
+   vbr = transcode_settings.get('vbr') or DEFAULT_VBR
+   if profile['vbr']:
+      vbr = min(profile['vbr'], vbr) # a faster profile never raises the bitrate the publisher asked for
+
+   if output_fname is None:
+      output_fname = f"{dest_folder}/{transcode_settings['preferred_output_filename']}"
+
    # now do the run..
-   final_args = ["rkmppenc", "-c", "hevc", "--preset", "best", "--audio-codec", "aac", "--vbr", "700"] + ["-i", input_recording_fname, "-o", f"{dest_folder}/{transcode_settings['preferred_output_filename']}"] + crop_settings + interlace_settings + output_settings + upscale_settings
+   final_args = ["rkmppenc", "-c", "hevc", "--preset", profile['preset'], "--audio-codec", "aac", "--vbr", str(vbr)] + input_settings + ["-i", input_recording_fname, "-o", output_fname] + crop_settings + interlace_settings + output_settings + upscale_settings
    print(final_args)
-   exit_status = subprocess.call(final_args)
+   proc = subprocess.Popen(final_args, stdin=stdin, stderr=subprocess.PIPE)
+   watch_progress(proc.stderr, transcode_settings.get('media_info'), on_progress)
+   exit_status = proc.wait()
    print(f"{final_args} finished with exit status {exit_status}")
-   os.unlink(input_recording_fname) 
+   return exit_status
+
+def stream_transcode(transcode_settings:dict, dest_folder='/nfs', on_progress=None, profile:dict=ENCODE_PROFILES['best'], output_fname:str=None) -> int:
+   source = open_recording_stream(transcode_settings, transcode_settings.get('ssh_user', 'hts'), transcode_settings.get('ssh_host', 'opi2.lan'), transcode_settings.get('ssh_folder_prefix', 'recordings'))
+   try:
+      exit_status = run_transcode(transcode_settings, '-', dest_folder=dest_folder, stdin=source.stdout, on_progress=on_progress, profile=profile, output_fname=output_fname)
+   finally:
+      source.stdout.close()
+      if source.poll() is None:
+         source.terminate() # rkmppenc gave up early, no point reading the rest of the recording
+      ssh_exit_status = source.wait()
+   if ssh_exit_status != 0 and exit_status == 0:
+      print(f"WARNING: streaming {transcode_settings['recording_file']} finished with ssh exit status {ssh_exit_status}... output may be truncated")
+      exit_status = ssh_exit_status
+   return exit_status
+
+def profile_fps(name:str, media_info:dict) -> float:
+   fps = ENCODE_PROFILES[name]['fps']
+   key = resolution_key(media_info) if media_info and media_info.get('width') else "1920x1080"
+   return measured_fps.get((name, key)) or fps.get(key) or fps["1920x1080"]
+
+def update_profile_fps(name:str, media_info:dict, frames:int, wall_time:float) -> None:
+   if not frames or wall_time <= 0 or not media_info or not media_info.get('width'):
+      return
+   key = (name, resolution_key(media_info))
+   with slot_lock:
+      fps = frames / wall_time
+      measured_fps[key] = fps if key not in measured_fps else 0.7 * measured_fps[key] + 0.3 * fps
+
+def held_jobs() -> tuple:
+   # jobs this worker has taken from the broker but not finished: queued for prefetch, prefetched and encoding
+   with work_queue.mutex:
+      jobs = [r for priority, sequence, r, delivery in work_queue.queue]
+   for q in (ready_queue, fast_queue):
+      if q is not None:
+         with q.mutex:
+            jobs += [r for priority, sequence, r, delivery, fname in q.queue]
+   with slot_lock:
+      encoding = [dict(status) for status in slot_status.values()]
+   return [r for r in jobs if isinstance(r, dict)], encoding
+
+def backlog_seconds(name:str, slots:int) -> float:
+   # estimated time to clear this worker's jobs plus its share of the fleet backlog using profile name
+   queued, encoding = held_jobs()
+   seconds = 0.0
+   for r in queued:
+      media_info = r.get('media_info') or {}
+      seconds += (media_info.get('duration') or 0) * (media_info.get('frame_rate') or 25) / profile_fps(name, media_info)
+   for status in encoding:
+      if status.get('eta') is not None:
+         seconds += status['eta']
+   # fleet backlog is in job cost (1080p frame equivalents)
+   seconds += (fleet_backlog.get('cost') or 0) / max(1, fleet_backlog.get('workers') or 1) / profile_fps(name, None)
+   return seconds / slots
+
+def backlog_jobs() -> int:
+   queued, encoding = held_jobs()
+   return len(queued) + len(encoding) + (fleet_backlog.get('jobs') or 0) // max(1, fleet_backlog.get('workers') or 1)
+
+def choose_profile(fixed:str, slots:int, target_seconds:float, target_jobs:int) -> str:
+   # the best profile expected to clear the backlog within target, or the fastest if none will. Re-evaluated for
+   # every job so the worker returns to best as the backlog clears
+   if fixed != 'auto':
+      return fixed
+   names = list(ENCODE_PROFILES.keys())
+   if target_jobs and backlog_jobs() > target_jobs:
+      names = names[1:] # too many jobs waiting regardless of their length, at least give up the best preset
+   for name in names:
+      if not target_seconds or backlog_seconds(name, slots) <= target_seconds:
+         return name
+   return names[-1]
+
+def job_priority(recording:dict) -> int:
+   # set by the publisher's --priority rules, higher is sooner
+   return (recording.get('priority') or 0) if isinstance(recording, dict) else 0
+
+def fast_job(recording:dict) -> bool:
+   if not isinstance(recording, dict):
+      return False
+   duration = (recording.get('media_info') or {}).get('duration')
+   return job_priority(recording) > 0 or (duration is not None and duration <= short_seconds)
+
+def job_rank(recording:dict) -> tuple:
+   # highest priority first, then short jobs ahead of films of the same priority so the reserved slot's prefetcher finds them
+   return (-job_priority(recording), not fast_job(recording))
+
+def take_job(fast_only:bool) -> tuple:
+   # the fast prefetcher only takes jobs for the reserved slot, which job_rank() puts at the head of work_queue
+   priority, sequence, r, delivery = work_queue.get(block=True, timeout=10)
+   if fast_only and not fast_job(r):
+      work_queue.put((priority, sequence, r, delivery)) # same rank and sequence, so it keeps its place
+      sleep(1)
+      raise Empty
+   return (priority, sequence, r, delivery)
+
+def next_ready(reserved:bool) -> tuple:
+   # the reserved slot only takes short or priority jobs, the other slots take those first and then anything
+   if reserved:
+      return fast_queue.get(block=True, timeout=10)
+   if fast_queue is None:
+      return ready_queue.get(block=True, timeout=10)
+   try:
+      return fast_queue.get(block=False)
+   except Empty:
+      # short wait so a job arriving on fast_queue whilst the reserved slot is busy is not left for long
+      return ready_queue.get(block=True, timeout=1)
+
+def job_id(recording:dict) -> str:
+   if 'segment' in recording:
+      return f"{recording.get('uuid')}/{recording['segment']['index']}"
+   return recording.get('uuid') or recording.get('preferred_output_filename')
+
+def trace_attrs(recording:dict) -> dict:
+   # segments of a recording share its trace id, see tracing.py
+   return { "segment": recording['segment']['index'] } if 'segment' in recording else {}
+
+def update_cost_rate(cost:float, wall_time:float) -> None:
+   # moving average, so a board's advertised capacity follows what it actually achieves
+   global slot_cost_rate
+   if not cost or wall_time <= 0:
+      return
+   with slot_lock:
+      rate = cost / wall_time
+      slot_cost_rate = rate if slot_cost_rate is None else 0.7 * slot_cost_rate + 0.3 * rate
+
+def update_slot(slot:int, progress:dict) -> None:
+   with slot_lock:
+      if slot in slot_status:
+         slot_status[slot].update(progress)
+
+def publish_status(subtopic:str, payload:dict, qos:int=0) -> None:
+   ret = client.publish(f"{status_topic}/{worker_id}/{subtopic}", json.dumps(payload, sort_keys=True), qos=qos)
+   if ret[0] != MQTTErrorCode.MQTT_ERR_SUCCESS:
+      print(f"Unable to publish {subtopic} status: {ret}")
+
+def publish_heartbeat(scratch_dir:str, slots:int, accepts:int, capacity:float) -> None:
+   with slot_lock:
+      jobs = [dict(status, slot=slot) for slot, status in slot_status.items()]
+      if slot_cost_rate is not None:
+         capacity = slot_cost_rate * slots
+   publish_status("heartbeat", {
+      "worker": worker_id,
+      "time": time(),
+      "slots": slots,
+      # for job-dispatcher.py: jobs this worker can hold at once and job cost it encodes per second
+      "accepts": accepts,
+      "capacity": capacity,
+      "slots_busy": len(jobs),
+      "jobs": jobs,
+      "queued": ready_queue.qsize() + (fast_queue.qsize() if fast_queue is not None else 0),
+      # jobs (slot and prefetched) held back for short or priority ones, see job-dispatcher.py
+      "reserved": 1 + fast_queue.maxsize if fast_queue is not None else 0,
+      "reserve_seconds": short_seconds,
+      "scratch_free": shutil.disk_usage(scratch_dir).free,
+      "failed_uploads": len(failed_uploads)
+   })
+
+def finish_job(r:dict, delivery, dest_folder:str, result:dict) -> None:
+   # the output (if any) is now in the destination folder: report the job, join segments and release the job message
+   output_fname = f"{dest_folder}/{r.get('preferred_output_filename')}"
+   result.update(output=output_fname, output_bytes=os.path.getsize(output_fname) if os.path.exists(output_fname) else 0)
+   if result['exit_status'] == 0 and os.path.exists(output_fname):
+      write_manifest(output_fname, r)
+   # the segment folder is gone once the parts have been joined eg. a part redelivered after the join
+   if 'segment' in r and os.path.isdir(segment_folder(dest_folder, r['segment']['group'])):
+      if result['exit_status'] != 0:
+         # the group can only be joined once every part is done, so a failed part goes round again
+         if not retry_segment(r):
+            mark_part_failed(dest_folder, r['segment'], f"exit status {result['exit_status']} after {r.get('attempt', 0)} retries")
+            result['segment_group_failed'] = r['segment']['output']
+      elif mark_part_done(dest_folder, r['segment'], result['exit_status']):
+         with span(r.get('trace_id'), 'concat', segments=r['segment']['count']) as attrs:
+            attrs['ok'] = concat_segments(dest_folder, r['segment'])
+         if attrs['ok']:
+            write_manifest(f"{dest_folder}/{r['segment']['output']}", r, whole=True)
+   publish_status("result", result, qos=1)
+   ack_job(client, delivery)
+
+def fail_unstarted_job(r, delivery, dest_folder:str, error:str) -> None:
+   # a job which never reached a slot is reported like any other, job-dispatcher.py only frees its assignment on a result
+   result = { "worker": worker_id, "job_id": job_id(r) if isinstance(r, dict) else None, "exit_status": -1, "error": error,
+              "started": time(), "wall_time": 0, "input_bytes": 0, "frames": None }
+   if not isinstance(r, dict):
+      publish_status("result", result, qos=1)
+      ack_job(client, delivery)
+      return
+   result.update(cost=r.get('cost'), duration=(r.get('media_info') or {}).get('duration'))
+   finish_job(r, delivery, dest_folder, result)
+
+def retry_segment(r:dict) -> bool:
+   # republishes a failed segment for any worker to try again, False once out of retries
+   attempt = r.get('attempt', 0) + 1
+   if attempt > SEGMENT_RETRIES:
+      return False
+   ret = client.publish(jobs_topic, json.dumps(dict(r, attempt=attempt)), qos=1)
+   # whilst disconnected paho queues the publish and sends it on reconnect
+   if ret[0] not in (MQTTErrorCode.MQTT_ERR_SUCCESS, MQTTErrorCode.MQTT_ERR_NO_CONN):
+      print(f"Unable to republish segment {job_id(r)} for retry: {ret}")
+      return False
+   print(f"Republished segment {job_id(r)} for retry #{attempt}")
+   return True
+
+def encode_slot(slot:int, dest_folder:str='/nfs', profile_settings:tuple=('best', 1, 0, 0), scratch_dir:str=None, reserved:bool=False) -> None:
+   # runs in its own thread, one per --slots, so several rkmppenc processes can share the VPU cores.
+   # With a scratch_dir (--local-output) rkmppenc writes there and the uploaders move the result to dest_folder,
+   # so a slow NAS does not stall the encoder and a failed encode never leaves a partial file in the library
+   while not done:
+      try:
+         priority, sequence, r, delivery, input_recording_fname = next_ready(reserved)
+      except Empty:
+         # not done, just nothing reported for now, keep going
+         continue
+      profile = choose_profile(*profile_settings)
+      print(f"Transcoding recording {r} in slot {slot} using the {profile} profile")
+      started = time()
+      record_span(r.get('trace_id'), 'ready_wait', delivery.get('ready_at'), started, **trace_attrs(r))
+      with slot_lock:
+         slot_status[slot] = { "job_id": job_id(r), "profile": profile, "cost": r.get('cost'), "started": started, "fps": None, "percent": None, "eta": None, "frames": 0 }
+      exit_status = None
+      input_bytes = (r.get('media_info') or {}).get('size')
+      if 'segment' in r:
+         os.makedirs(os.path.dirname(f"{dest_folder}/{r['preferred_output_filename']}"), exist_ok=True)
+      local_output = new_scratch_file(scratch_dir, prefix="output-", suffix=".mkv") if scratch_dir else None
+      try:
+         if input_recording_fname is None:
+            exit_status = stream_transcode(r, dest_folder, on_progress=lambda progress: update_slot(slot, progress), profile=ENCODE_PROFILES[profile], output_fname=local_output)
+         else:
+            input_bytes = os.path.getsize(input_recording_fname)
+            exit_status = run_transcode(r, input_recording_fname, dest_folder, on_progress=lambda progress: update_slot(slot, progress), profile=ENCODE_PROFILES[profile], output_fname=local_output)
+      finally:
+         if input_recording_fname is not None:
+            release_scratch_file(input_recording_fname)
+         with slot_lock:
+            status = slot_status.pop(slot, {})
+         result = {
+            "worker": worker_id,
+            "job_id": job_id(r),
+            "exit_status": exit_status,
+            "cost": r.get('cost'),
+            "profile": profile,
+            "started": started,
+            "wall_time": time() - started,
+            "input_bytes": input_bytes,
+            "frames": status.get('frames'),
+            "duration": (r.get('media_info') or {}).get('duration')
+         }
+         record_span(r.get('trace_id'), 'stream_encode' if input_recording_fname is None else 'encode', started, time(),
+                     profile=profile, exit_status=exit_status, slot=slot, **trace_attrs(r))
+      if done or exit_status == -signal.SIGINT:
+         # Ctrl-C reaches rkmppenc too: not a failed job, leave it unacknowledged for the broker to redeliver
+         print(f"Encode of {job_id(r)} interrupted... left unacknowledged for redelivery")
+         if local_output is not None:
+            release_scratch_file(local_output)
+         continue
+      if exit_status == 0:
+         update_cost_rate(r.get('cost'), time() - started)
+         update_profile_fps(profile, r.get('media_info'), status.get('frames'), time() - started)
+      if local_output is None:
+         finish_job(r, delivery, dest_folder, result)
+      elif exit_status != 0:
+         release_scratch_file(local_output) # nothing partial reaches the destination
+         finish_job(r, delivery, dest_folder, result)
+      else:
+         # blocks when the uploaders are behind, rather than filling scratch with encoded files
+         queued = False
+         while not queued and not done:
+            try:
+               delivery['encoded_at'] = time()
+               upload_queue.put((r, delivery, local_output, result), block=True, timeout=10)
+               queued = True
+            except Full:
+               pass
+
+def due_failed_upload() -> tuple:
+   # the oldest failed upload whose retry is due, or None
+   with scratch_lock:
+      for i, (r, delivery, local_output, result, failed_at) in enumerate(failed_uploads):
+         if time() - failed_at >= UPLOAD_RETRY_INTERVAL:
+            failed_uploads.pop(i)
+            return (r, delivery, local_output, result)
+   return None
+
+def hold_failed_upload(r:dict, delivery, local_output:str, result:dict, dest_folder:str, keep_failed:int) -> None:
+   # the encode stays in scratch, counted against the budget and with its job unacknowledged, to be uploaded again
+   # later. Beyond keep_failed the oldest is given up and reported, so scratch cannot fill up with them
+   with scratch_lock:
+      failed_uploads.append((r, delivery, local_output, result, time()))
+      given_up = failed_uploads.pop(0) if len(failed_uploads) > keep_failed else None
+   if given_up is not None:
+      r, delivery, local_output, result, failed_at = given_up
+      print(f"Giving up on uploading {local_output} for {job_id(r)}, {len(failed_uploads)} other failed uploads held")
+      release_scratch_file(local_output)
+      result['exit_status'] = -1
+      result['upload_failed'] = True
+      finish_job(r, delivery, dest_folder, result)
+
+def upload_outputs(dest_folder:str, verify:str='size', limit_bytes_per_sec:int=0, keep_failed:int=2) -> None:
+   # runs in its own thread, one per --upload-threads: moves encoded files from scratch to the destination while the
+   # slots carry on with the next encode. The job is only acknowledged once its output is safely in place
+   while not done:
+      try:
+         r, delivery, local_output, result = upload_queue.get(block=True, timeout=10)
+      except Empty:
+         # nothing new to upload, a good time to try a failed one again
+         failed = due_failed_upload()
+         if failed is None:
+            continue
+         r, delivery, local_output, result = failed
+      started = time()
+      record_span(r.get('trace_id'), 'upload_wait', delivery.get('encoded_at'), started, **trace_attrs(r))
+      with span(r.get('trace_id'), 'upload', **trace_attrs(r)) as attrs:
+         attrs['ok'] = upload_file(local_output, f"{dest_folder}/{r['preferred_output_filename']}", verify=verify, limit_bytes_per_sec=limit_bytes_per_sec)
+      result['upload_time'] = time() - started
+      if attrs['ok']:
+         release_scratch_file(local_output)
+         finish_job(r, delivery, dest_folder, result)
+      else:
+         # keep the encode rather than redoing hours of work
+         print(f"Unable to upload {local_output} to {dest_folder}/{r['preferred_output_filename']}... will try again in {UPLOAD_RETRY_INTERVAL}s")
+         hold_failed_upload(r, delivery, local_output, result, dest_folder, keep_failed)
     
 if __name__ == "__main__":
    a = argparse.ArgumentParser(description="Run transcoding jobs via rkmppenc from MQTT topic hosted on a broker")
@@ -107,33 +725,91 @@ if __name__ == "__main__":
    a.add_argument("--cafile", help="Certificate Authority Certificate filename [ca.crt] ", type=str, default="ca.crt")
    a.add_argument("--cert", help="Host certificate filename [host.crt] ", type=str, default="host.crt")
    a.add_argument("--key", help="Host private key filename [host.key] ", type=str, default="host.key")
+   a.add_argument("--dest-folder", help="Folder to write transcoded recordings to [/nfs] ", type=str, default="/nfs")
+   a.add_argument("--scratch-dir", help="Folder to download recordings into prior to transcoding [.] ", type=str, default=".")
+   a.add_argument("--scratch-budget", help="Maximum GB of recordings to hold in the scratch folder [20] ", type=float, default=20.0)
+   a.add_argument("--prefetch", help="Number of recordings to download ahead of the current transcode [1] ", type=int, default=1)
+   a.add_argument("--prefetch-threads", help="Number of recordings to download concurrently, at most one per source host [2] ", type=int, default=2)
+   a.add_argument("--verify", help="How to check a downloaded recording against the source, and an uploaded output against the local copy: size or sha256 [size] ", type=str, choices=['size', 'sha256'], default='size')
+   a.add_argument("--slots", help="Number of rkmppenc processes to run concurrently [1] ", type=int, default=1)
+   a.add_argument("--status-topic", help="Topic prefix for heartbeats and job results, suffixed by /<worker>/heartbeat or /<worker>/result [video/status] ", type=str, default="video/status")
+   a.add_argument("--heartbeat-interval", help="Seconds between heartbeats [30] ", type=int, default=30)
+   a.add_argument("--dispatched", help="Take jobs assigned to this worker by job-dispatcher.py rather than from the shared topic [False] ", action="store_true")
+   a.add_argument("--capacity", help="Job cost this board encodes per second across all slots, advertised until measured from finished jobs [200] ", type=float, default=200)
+   # the broker only lets each board hold a few jobs (ReceiveMaximum), so auto only sees the whole backlog via job-dispatcher.py
+   a.add_argument("--profile", help=f"Encode profile, or auto to pick the best one which keeps the backlog within target. Without job-dispatcher.py the backlog is just the few jobs this board holds: auto, {', '.join(ENCODE_PROFILES)} [auto] ",
+                  type=str, choices=['auto'] + list(ENCODE_PROFILES), default='auto')
+   a.add_argument("--backlog-target", help="Hours of encoding the backlog may reach before auto switches to a faster profile, 0 for no limit [24] ", type=float, default=24)
+   a.add_argument("--queue-target", help="Jobs waiting per worker before auto gives up the best profile, 0 for no limit [0] ", type=int, default=0)
+   a.add_argument("--local-output", help="Encode into the scratch folder and upload finished files to the destination in the background [False] ", action="store_true")
+   a.add_argument("--upload-threads", help="Number of concurrent uploads to the destination with --local-output [1] ", type=int, default=1)
+   a.add_argument("--upload-queue", help="Encoded files that may wait for upload before the slots pause [2] ", type=int, default=2)
+   a.add_argument("--keep-failed-uploads", help="Encoded files whose upload failed to keep in scratch and retry, beyond this the oldest is given up and reported [2] ", type=int, default=2)
+   a.add_argument("--upload-mbps", help="Limit each upload to this many MB/s, 0 for no limit [0] ", type=float, default=0)
+   a.add_argument("--reserve-slot", help="Keep one of the slots for jobs shorter than this many minutes or with a priority, so they never wait behind films, 0 for none [0] ", type=float, default=0)
+   a.add_argument("--trace-file", help="Append per-stage timings of each job to this JSONL file for trace-report.py, empty to disable [] ", type=str, default="")
+   a.add_argument("--stream", help="Stream recordings over ssh into rkmppenc rather than downloading them, where the job permits [False] ", action="store_true")
    args = a.parse_args()
+   assert args.prefetch >= 1
+   assert args.slots >= 1
+   assert args.prefetch_threads >= 1
+   assert args.reserve_slot == 0 or args.slots >= 2
    share_topic = args.mqtt_topic
-   client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"rkmppenc{os.getpid()}", protocol=mqtt.MQTTv5)
-      # FALLTHRU
+   jobs_topic = args.mqtt_topic.split('/', 2)[-1] if args.mqtt_topic.startswith('$share/') else args.mqtt_topic
+   if args.dispatched:
+      assign_topic = f"{jobs_topic}/worker/{worker_id}"
+   status_topic = args.status_topic
+   open_trace(args.trace_file, worker_id)
+   ready_queue = PriorityQueue(maxsize=args.prefetch)
+   if args.reserve_slot > 0:
+      fast_queue = PriorityQueue(maxsize=FAST_QUEUE_SIZE)
+      short_seconds = args.reserve_slot * 60
+   upload_queue = Queue(maxsize=args.upload_queue)
+   client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"rkmppenc{os.getpid()}", protocol=mqtt.MQTTv5, manual_ack=True)
+   # flow control: the broker will not hand us more unacknowledged jobs than we can be encoding, holding in ready_queue or fetching
+   connect_properties = Properties(PacketTypes.CONNECT)
+   connect_properties.ReceiveMaximum = args.slots + args.prefetch + args.prefetch_threads + (args.upload_queue + args.upload_threads + args.keep_failed_uploads if args.local_output else 0) + (fast_queue.maxsize + 1 if fast_queue is not None else 0)
+   # a dispatcher need only keep the slots and the prefetched recordings fed, it holds back the rest to order them
+   accepts = args.slots + args.prefetch + (fast_queue.maxsize if fast_queue is not None else 0)
    client.on_message = on_message
    client.on_connect = on_connect
    client.on_disconnect = on_disconnect
-   client.tls_set(ca_certs=args.cafile, certfile=args.cert, keyfile=args.key)
-   client.connect(args.mqtt_broker, port=args.mqtt_port)
+   client.reconnect_delay_set(min_delay=1, max_delay=60)
+   if args.cafile: # empty for a plain TCP broker eg. the benchmark's stand-in
+      client.tls_set(ca_certs=args.cafile, certfile=args.cert, keyfile=args.key)
+   client.connect(args.mqtt_broker, port=args.mqtt_port, properties=connect_properties)
    client.loop_start()
-   print(f"Subscribed to {args.mqtt_topic}... now waiting for transcode jobs (indefinately)...")
-   while not done:
-      # slow process things in main thread one-at-a-time ie. user interaction since not permitted in callback thread
-      try:
-         while True:
-             r = work_queue.get(block=True, timeout=10)
-             if not isinstance(r, dict):
-                 print(f"ERROR: got recording {r} but not expected JSON type... skipping")
-                 continue
-             print(f"Transcoding recording {r}")
-             input_recording_fname = fetch_recording(r, r.get('ssh_user', 'hts'), r.get('ssh_host', 'opi2.lan'), r.get('ssh_folder_prefix', 'recordings'))
-             if input_recording_fname:
-                run_transcode(r, input_recording_fname)
-             else:
-                print(f"Unable to fetch recording {r}... ignoring but continuing to process remaining recordings")
-      except Empty:
-         # not done, just nothing reported for now, keep going
-         pass
+   print(f"Subscribed to {assign_topic or args.mqtt_topic}... now waiting for transcode jobs (indefinately)...")
+   prefetchers = [threading.Thread(target=prefetch_recordings, args=(args.scratch_dir, int(args.scratch_budget * 1024 * 1024 * 1024), args.stream, args.verify, args.dest_folder), daemon=True)
+                  for i in range(args.prefetch_threads)]
+   if fast_queue is not None:
+      prefetchers.append(threading.Thread(target=prefetch_recordings, args=(args.scratch_dir, int(args.scratch_budget * 1024 * 1024 * 1024), args.stream, args.verify, args.dest_folder, True), daemon=True))
+   for t in prefetchers:
+      t.start()
+   # recordings are fetched ahead of time by the prefetch threads, so the encode slots are not left idle during downloads
+   profile_settings = (args.profile, args.slots, args.backlog_target * 3600, args.queue_target)
+   # with --reserve-slot the last slot only encodes short or priority jobs
+   slots = [threading.Thread(target=encode_slot, args=(slot, args.dest_folder, profile_settings, args.scratch_dir if args.local_output else None,
+                                                       fast_queue is not None and slot == args.slots - 1), daemon=True) for slot in range(args.slots)]
+   if args.local_output:
+      slots += [threading.Thread(target=upload_outputs, args=(args.dest_folder, args.verify, int(args.upload_mbps * 1024 * 1024), args.keep_failed_uploads), daemon=True) for i in range(args.upload_threads)]
+   for t in slots:
+      t.start()
+   try:
+      while not done:
+         publish_heartbeat(args.scratch_dir, args.slots, accepts, args.capacity)
+         sleep(args.heartbeat_interval)
+   except KeyboardInterrupt:
+      print("Interrupted... removing scratch recordings")
+   done = True
+   with scratch_freed:
+      scratch_freed.notify_all()
+   for t in prefetchers:
+      t.join(timeout=30)
+   for t in slots:
+      t.join(timeout=30)
+   cleanup_scratch()
+   client.disconnect()
    client.loop_stop()
+   close_trace()
    exit(0)
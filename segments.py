@@ -0,0 +1,110 @@
+# segment-parallel transcoding of long recordings. The publisher cuts the recording at video keyframes into byte ranges
+# of the transport stream and publishes each as a sub-job; any worker encodes any segment, and whichever worker finishes
+# the last one concatenates the parts (stream copy) into the final output and checks the total duration
+import os
+import subprocess
+from mediainfo import probe_media_info
+
+TS_PACKET = 188
+SEGMENTS_FOLDER = '.segments' # under the destination folder, one sub-folder per recording uuid
+SEGMENT_RETRIES = 2 # a failed segment is republished this many times before its group is given up
+
+def probe_keyframes(local_file:str) -> list:
+   # returns [(seconds from start, byte position)] of video keyframe packets, without decoding anything
+   ffprobe_results = subprocess.run(["ffprobe", "-v", "quiet", "-select_streams", "v:0", "-show_entries", "packet=pts_time,pos,flags", "-of", "csv=p=0", local_file], capture_output=True)
+   if ffprobe_results.returncode != 0:
+      return []
+   keyframes = []
+   for line in ffprobe_results.stdout.decode('utf-8').split("\n"):
+      fields = line.strip().split(',')
+      if len(fields) < 3 or 'K' not in fields[2]:
+         continue
+      try:
+         keyframes.append((float(fields[0]), int(fields[1])))
+      except ValueError:
+         continue
+   if not any(keyframes):
+      return []
+   first = keyframes[0][0]
+   return [(t - first, pos) for t, pos in keyframes]
+
+def plan_segments(keyframes:list, duration:float, size:int, segment_seconds:float) -> list:
+   # cut at the first keyframe at or after each multiple of segment_seconds, aligned to a TS packet
+   cuts = [(0.0, 0)]
+   target = segment_seconds
+   for t, pos in keyframes:
+      if t >= target and duration - t >= segment_seconds / 4: # don't leave a tiny final segment
+         cuts.append((t, pos - pos % TS_PACKET))
+         target = t + segment_seconds
+   segments = []
+   for i, (start, first_byte) in enumerate(cuts):
+      end, last_byte = cuts[i + 1] if i + 1 < len(cuts) else (duration, size)
+      segments.append({ "index": i, "count": len(cuts), "start": start, "end": end, "first_byte": first_byte, "length": last_byte - first_byte })
+   return segments
+
+def segment_folder(dest_folder:str, group:str) -> str:
+   return os.path.join(dest_folder, SEGMENTS_FOLDER, group)
+
+def part_filename(group:str, index:int) -> str:
+   # relative to the destination folder, used as the sub-job's preferred_output_filename
+   return os.path.join(SEGMENTS_FOLDER, group, f"part-{index:03d}.mkv")
+
+def mark_part_done(dest_folder:str, segment:dict, exit_status:int) -> bool:
+   # returns True if this was the last outstanding part and the caller has won the right to concatenate
+   folder = segment_folder(dest_folder, segment['group'])
+   if exit_status == 0:
+      with open(os.path.join(folder, f"part-{segment['index']:03d}.done"), 'w') as fp:
+         fp.write(f"{segment['start']} {segment['end']}\n")
+   done_parts = [f for f in os.listdir(folder) if f.endswith('.done')]
+   if len(done_parts) < segment['count']:
+      return False
+   try:
+      os.close(os.open(os.path.join(folder, "concat.lock"), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+      return True
+   except FileExistsError:
+      return False # another worker finished its part at the same moment and is concatenating
+
+def mark_part_failed(dest_folder:str, segment:dict, reason:str) -> None:
+   # out of retries: the group can never be joined, leave the parts and a note for the operator
+   folder = segment_folder(dest_folder, segment['group'])
+   with open(os.path.join(folder, f"part-{segment['index']:03d}.failed"), 'w') as fp:
+      fp.write(f"{reason}\n")
+   print(f"Segment {segment['index']} of {segment['output']} failed for good ({reason})... parts left in {folder}")
+
+def concat_failed(folder:str, part_output:str) -> bool:
+   # releases the join so that a redelivered part can try again, and drops whatever ffmpeg wrote
+   try:
+      os.unlink(part_output)
+   except FileNotFoundError:
+      pass
+   os.unlink(os.path.join(folder, "concat.lock"))
+   return False
+
+def concat_segments(dest_folder:str, segment:dict) -> bool:
+   folder = segment_folder(dest_folder, segment['group'])
+   output = os.path.join(dest_folder, segment['output'])
+   # joined under a hidden name and renamed into place once checked, as transfer.upload_file() does, so the media
+   # library never sees a partial or short file
+   part_output = os.path.join(os.path.dirname(output), f".{os.path.basename(output)}.part")
+   list_file = os.path.join(folder, "parts.txt")
+   with open(list_file, 'w') as fp:
+      for i in range(segment['count']):
+         fp.write(f"file 'part-{i:03d}.mkv'\n")
+   ffmpeg_args = ["ffmpeg", "-hide_banner", "-y", "-f", "concat", "-safe", "0", "-i", list_file, "-map", "0", "-c", "copy", "-f", "matroska", part_output]
+   print(f"Concatenating {segment['count']} segments using: {ffmpeg_args}")
+   exit_status = subprocess.call(ffmpeg_args)
+   if exit_status != 0:
+      print(f"Failed to concatenate segments of {segment['output']} (exit status {exit_status})... parts left in {folder}")
+      return concat_failed(folder, part_output)
+   media_info = probe_media_info(part_output)
+   expected = segment['duration']
+   actual = media_info.get('duration') if media_info else None
+   if expected and (actual is None or abs(actual - expected) > max(2.0 * segment['count'], 0.005 * expected)):
+      print(f"Duration check failed for {output}: {actual}s vs {expected}s expected... parts left in {folder}")
+      return concat_failed(folder, part_output)
+   os.replace(part_output, output)
+   print(f"Concatenated {output}: {actual}s (expected {expected}s)")
+   for f in os.listdir(folder):
+      os.unlink(os.path.join(folder, f))
+   os.rmdir(folder)
+   return True
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+# usage:
+#   python3 trace-report.py publisher.jsonl worker-*.jsonl
+# merges the --trace-file output of video-source-job-publisher.py and run-rkmppenc.py (copied from each host) and
+# prints how long each stage takes, and which stages lie on the critical path from a recording being seen to its
+# output being in place, ie. which bottleneck is worth attacking next
+import glob
+import json
+import argparse
+from collections import defaultdict
+
+def percentile(values:list, p:float) -> float:
+   if not any(values):
+      return 0.0
+   values = sorted(values)
+   return values[min(len(values) - 1, int(p * len(values)))]
+
+def load_spans(patterns:list) -> dict:
+   # trace id -> spans, oldest first
+   traces = defaultdict(list)
+   for pattern in patterns:
+      for fname in sorted(glob.glob(pattern)):
+         with open(fname) as fp:
+            for line in fp:
+               try:
+                  s = json.loads(line)
+               except ValueError:
+                  continue # eg. the last line of a file still being written
+               if isinstance(s, dict) and s.get('trace') and s.get('start') is not None and s.get('end') is not None:
+                  traces[s['trace']].append(s)
+   for spans in traces.values():
+      spans.sort(key=lambda s: (s['start'], s['end']))
+   return traces
+
+def critical_path(spans:list) -> list:
+   # walks back from the span which ends last, each time to the span which ended most recently before the current one
+   # started. Time not covered by any span (eg. the operator loop or a clock step between hosts) counts as untracked.
+   # Returns [(stage, seconds)] in time order
+   path = []
+   visited = set() # zero length spans eg. skipped could otherwise lead back to each other
+   current = max(spans, key=lambda s: s['end'])
+   while current is not None:
+      visited.add(id(current))
+      path.append((current['stage'], current['end'] - current['start']))
+      before = [s for s in spans if s['end'] <= current['start'] and id(s) not in visited]
+      previous = max(before, key=lambda s: s['end'], default=None)
+      if previous is not None and current['start'] - previous['end'] > 0:
+         path.append(('untracked', current['start'] - previous['end']))
+      current = previous
+   return list(reversed(path))
+
+def report(traces:dict, slowest:int) -> None:
+   durations = defaultdict(list)
+   for spans in traces.values():
+      for s in spans:
+         durations[s['stage']].append(s['end'] - s['start'])
+   print(f"=== {len(traces)} traces, {sum(len(v) for v in durations.values())} spans")
+   print(f"    {'stage':14s} {'count':>6s} {'p50':>9s} {'p90':>9s} {'max':>9s} {'total':>10s}")
+   for stage, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+      print(f"    {stage:14s} {len(values):6d} {percentile(values, 0.5):8.2f}s {percentile(values, 0.9):8.2f}s {max(values):8.2f}s {sum(values):9.0f}s")
+
+   paths = {}
+   for trace_id, spans in traces.items():
+      paths[trace_id] = (max(s['end'] for s in spans) - min(s['start'] for s in spans), critical_path(spans))
+   on_path = defaultdict(float)
+   for elapsed, path in paths.values():
+      for stage, seconds in path:
+         on_path[stage] += seconds
+   total = sum(on_path.values())
+   print(f"=== critical path, share of {total:.0f}s end to end across all traces")
+   for stage, seconds in sorted(on_path.items(), key=lambda item: -item[1]):
+      print(f"    {stage:14s} {100 * seconds / max(total, 1e-6):5.1f}%  {seconds:9.0f}s")
+
+   print(f"=== slowest {slowest} traces")
+   for trace_id, (elapsed, path) in sorted(paths.items(), key=lambda item: -item[1][0])[:slowest]:
+      print(f"    {trace_id} {elapsed:.0f}s: {' > '.join(f'{stage} {seconds:.0f}s' for stage, seconds in path)}")
+
+if __name__ == "__main__":
+   a = argparse.ArgumentParser(description="Per-stage timings and critical path of jobs traced with --trace-file")
+   a.add_argument("files", help="Trace files (or glob patterns) from the publisher and workers", nargs='+')
+   a.add_argument("--slowest", help="Number of slowest traces to show in full [10] ", type=int, default=10)
+   args = a.parse_args()
+   traces = load_spans(args.files)
+   if not any(traces):
+      print("No spans found")
+      exit(1)
+   report(traces, args.slowest)
+   exit(0)
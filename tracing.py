@@ -0,0 +1,47 @@
+# lightweight per-stage tracing shared by video-source-job-publisher.py and run-rkmppenc.py: the publisher gives each
+# recording a trace id which travels in the job, and every stage appends a timed span to a local JSONL file.
+# trace-report.py merges the files from all hosts (their clocks should be NTP synchronised)
+import json
+import socket
+import threading
+import uuid
+from time import time
+from contextlib import contextmanager
+
+trace_fp = None # tracing is off until open_trace() is given a file
+trace_lock = threading.Lock()
+source = socket.gethostname()
+
+def open_trace(path:str, name:str=None) -> None:
+   global trace_fp, source
+   if path:
+      trace_fp = open(path, 'a', buffering=1) # line buffered, so a killed process loses at most the span being written
+      source = name or source
+
+def close_trace() -> None:
+   global trace_fp
+   with trace_lock:
+      if trace_fp is not None:
+         trace_fp.close()
+         trace_fp = None
+
+def new_trace_id() -> str:
+   return uuid.uuid4().hex[:16]
+
+def record_span(trace_id:str, stage:str, start:float, end:float, **attrs) -> None:
+   # for stages measured across threads eg. time spent waiting in a queue
+   if trace_fp is None or not trace_id or start is None:
+      return
+   line = json.dumps(dict(attrs, trace=trace_id, stage=stage, source=source, start=start, end=end), sort_keys=True)
+   with trace_lock:
+      if trace_fp is not None:
+         trace_fp.write(line + "\n")
+
+@contextmanager
+def span(trace_id:str, stage:str, **attrs):
+   # times the enclosed block, the caller may add to the yielded attributes eg. an exit status
+   start = time()
+   try:
+      yield attrs
+   finally:
+      record_span(trace_id, stage, start, time(), **attrs)
@@ -0,0 +1,177 @@
+# recording transfers shared by video-source-job-publisher.py and run-rkmppenc.py: one multiplexed ssh connection per
+# source host (OpenSSH ControlMaster), resumable fetches which append from the last byte received, and size/checksum checks.
+# Also the upload of encoded files from local scratch to the (NFS) destination
+import os
+import shlex
+import hashlib
+import tempfile
+import threading
+import subprocess
+from time import sleep, time
+
+# concurrent fetches permitted from a single host, fetches from different hosts always run in parallel
+MAX_TRANSFERS_PER_HOST = 1
+UPLOAD_CHUNK = 4 * 1024 * 1024
+# a recording's fingerprint is its size plus a hash of a few chunks spread through it, cheap to compute over ssh
+FINGERPRINT_SAMPLES = 8
+FINGERPRINT_CHUNK = 64 * 1024
+
+host_slots = {}
+host_slots_lock = threading.Lock()
+
+def ssh_options() -> list:
+   # the first ssh to a host becomes the master, later ones reuse its connection and skip the handshake
+   control_path = os.path.join(tempfile.gettempdir(), "mqtt-rkmppenc-ssh-%C")
+   return ["-o", "ControlMaster=auto", "-o", f"ControlPath={control_path}", "-o", "ControlPersist=10m"]
+
+def ssh_target(ssh_user:str, ssh_host:str) -> str:
+   return f"{ssh_user}@{ssh_host}" if ssh_user else ssh_host
+
+def ssh_command(ssh_user:str, ssh_host:str, *remote_args) -> list:
+   return ["ssh"] + ssh_options() + [ssh_target(ssh_user, ssh_host)] + list(remote_args)
+
+def host_slot(ssh_host:str) -> threading.Semaphore:
+   with host_slots_lock:
+      if ssh_host not in host_slots:
+         host_slots[ssh_host] = threading.Semaphore(MAX_TRANSFERS_PER_HOST)
+      return host_slots[ssh_host]
+
+def remote_stat(ssh_user:str, ssh_host:str, remote_path:str) -> tuple:
+   # returns (size, mtime) or None if the file could not be stat'ed
+   results = subprocess.run(ssh_command(ssh_user, ssh_host, "stat", "-c", "'%s %Y'", shlex.quote(remote_path)), capture_output=True)
+   if results.returncode == 0:
+      try:
+         size, mtime = results.stdout.decode('utf-8').split()
+         return (int(size), int(mtime))
+      except ValueError:
+         pass
+   return None
+
+def remote_sha256(ssh_user:str, ssh_host:str, remote_path:str) -> str:
+   results = subprocess.run(ssh_command(ssh_user, ssh_host, "sha256sum", shlex.quote(remote_path)), capture_output=True)
+   if results.returncode == 0:
+      return results.stdout.decode('utf-8').split()[0]
+   return None
+
+def local_sha256(local_path:str) -> str:
+   h = hashlib.sha256()
+   with open(local_path, 'rb') as fp:
+      for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+         h.update(chunk)
+   return h.hexdigest()
+
+def local_size(local_path:str) -> int:
+   try:
+      return os.path.getsize(local_path)
+   except OSError:
+      return 0
+
+def fingerprint_blocks(size:int) -> list:
+   # FINGERPRINT_CHUNK sized blocks to sample, always including the first and last
+   blocks = max(1, size // FINGERPRINT_CHUNK)
+   return sorted(set(i * (blocks - 1) // (FINGERPRINT_SAMPLES - 1) for i in range(FINGERPRINT_SAMPLES)))
+
+def remote_fingerprint(ssh_user:str, ssh_host:str, remote_path:str) -> str:
+   # computed on the source host so that neither side needs the whole recording, None if it could not be read
+   st = remote_stat(ssh_user, ssh_host, remote_path)
+   if st is None:
+      return None
+   size = st[0]
+   reads = [f"dd if={shlex.quote(remote_path)} bs={FINGERPRINT_CHUNK} skip={block} count=1 2>/dev/null;" for block in fingerprint_blocks(size)]
+   results = subprocess.run(ssh_command(ssh_user, ssh_host, "(", *reads, ")", "|", "sha256sum"), capture_output=True)
+   if results.returncode != 0:
+      return None
+   return f"{size}-{results.stdout.decode('utf-8').split()[0][:32]}"
+
+def range_command(remote_path:str, offset:int, first_byte:int=0, length:int=None) -> list:
+   # remote command sending bytes [first_byte + offset, first_byte + length) of the file
+   # tail -c +N starts at byte N (1-based)
+   cmd = ["tail", "-c", f"+{first_byte + offset + 1}", shlex.quote(remote_path)]
+   if length is not None:
+      cmd += ["|", "head", "-c", str(length - offset)]
+   return cmd
+
+def fetch_file(ssh_user:str, ssh_host:str, remote_path:str, local_path:str, retries:int=3, retry_delay:int=30, verify:str='size', first_byte:int=0, length:int=None) -> bool:
+   # verify is one of 'size' or 'sha256'. On success the local file has the remote mtime (the media info cache relies on it).
+   # first_byte/length fetch just part of the file eg. one segment of a recording (size verification only)
+   with host_slot(ssh_host):
+      for retry in range(retries):
+         st = remote_stat(ssh_user, ssh_host, remote_path)
+         if st is None:
+            print(f"Unable to stat {ssh_target(ssh_user, ssh_host)}:{remote_path} (retry #{retry})- sleeping for {retry_delay}s")
+            sleep(retry_delay)
+            continue
+         size, mtime = st
+         if length is not None:
+            size = min(length, size - first_byte)
+         offset = local_size(local_path)
+         if offset > size:
+            offset = 0 # remote file has been replaced since the partial copy was made
+         if offset < size:
+            # a retry continues from the last byte received
+            ssh_args = ssh_command(ssh_user, ssh_host, *range_command(remote_path, offset, first_byte, size if length is not None else None))
+            print(f"Fetching {size - offset} of {size} bytes using: {ssh_args}")
+            with open(local_path, 'ab' if offset > 0 else 'wb') as fp:
+               exit_status = subprocess.call(ssh_args, stdout=fp)
+            if exit_status != 0:
+               print(f"Failed to fetch {remote_path} at {local_size(local_path)} bytes (retry #{retry})- sleeping for {retry_delay}s")
+               sleep(retry_delay)
+               continue
+         if local_size(local_path) != size:
+            print(f"Size mismatch for {remote_path}: {local_size(local_path)} local vs {size} remote (retry #{retry})")
+            continue
+         if verify == 'sha256' and length is None and local_sha256(local_path) != remote_sha256(ssh_user, ssh_host, remote_path):
+            print(f"Checksum mismatch for {remote_path} (retry #{retry})... fetching again from the start")
+            os.truncate(local_path, 0)
+            continue
+         os.utime(local_path, (mtime, mtime))
+         return True
+   return False
+
+def open_stream(ssh_user:str, ssh_host:str, remote_path:str, first_byte:int=0, length:int=None) -> subprocess.Popen:
+   if first_byte == 0 and length is None:
+      ssh_args = ssh_command(ssh_user, ssh_host, "cat", shlex.quote(remote_path))
+   else:
+      ssh_args = ssh_command(ssh_user, ssh_host, *range_command(remote_path, 0, first_byte, length))
+   print(f"Streaming recording using: {ssh_args}")
+   return subprocess.Popen(ssh_args, stdout=subprocess.PIPE)
+
+def upload_file(local_path:str, dest_path:str, verify:str='size', limit_bytes_per_sec:int=0, retries:int=3, retry_delay:int=30) -> bool:
+   # copies to a hidden name in the destination folder and renames it into place, so the destination (eg. a media
+   # library on NFS) never sees a partial file. Rename within a folder is atomic on NFS as well as locally
+   part_path = os.path.join(os.path.dirname(dest_path), f".{os.path.basename(dest_path)}.part")
+   size = local_size(local_path)
+   checksum = local_sha256(local_path) if verify == 'sha256' else None
+   for retry in range(retries):
+      try:
+         os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+         started = time()
+         copied = 0
+         with open(local_path, 'rb') as src, open(part_path, 'wb') as dst:
+            for chunk in iter(lambda: src.read(UPLOAD_CHUNK), b''):
+               dst.write(chunk)
+               copied += len(chunk)
+               if limit_bytes_per_sec > 0:
+                  ahead = copied / limit_bytes_per_sec - (time() - started)
+                  if ahead > 0:
+                     sleep(ahead)
+            dst.flush()
+            os.fsync(dst.fileno())
+         if local_size(part_path) != size or (checksum is not None and local_sha256(part_path) != checksum):
+            print(f"Verification of {part_path} against {local_path} failed (retry #{retry})... uploading again")
+            continue
+         os.replace(part_path, dest_path)
+         print(f"Uploaded {size} bytes to {dest_path} in {time() - started:.1f}s")
+         return True
+      except OSError as e:
+         print(f"Failed to upload {local_path} to {dest_path}: {e} (retry #{retry})- sleeping for {retry_delay}s")
+         sleep(retry_delay)
+   try:
+      os.unlink(part_path)
+   except OSError:
+      pass
+   return False
+
+def close_connections(ssh_user:str, ssh_hosts:list) -> None:
+   for ssh_host in ssh_hosts:
+      subprocess.run(["ssh"] + ssh_options() + ["-O", "exit", ssh_target(ssh_user, ssh_host)], capture_output=True)
@@ -8,21 +8,47 @@ import sys
 import json
 import re
 import traceback
+import socket
 import subprocess
-from time import sleep
 import argparse
+from time import time
 import paho.mqtt.client as mqtt
 from paho.mqtt.enums import MQTTErrorCode
-from queue import Queue, Empty # note: must be thread safe
-import sqlite3
+from queue import Queue, PriorityQueue, Empty, Full # note: must be thread safe
+from itertools import count
+import threading
+from mediainfo import probe_media_info, valid_media_info, job_cost
+from cropdetect import detect_crop
+from jobstore import JobStore
+from catalog import iter_entries, entry_stop
+from transfer import ssh_command, remote_stat, remote_fingerprint, fetch_file, close_connections
+from segments import probe_keyframes, plan_segments, part_filename
+from tracing import open_trace, close_trace, new_trace_id, record_span, span
 
 class SkipJob(Exception):
   def __init__(self, message):
       super().__init__(message)
 
-work_queue = Queue()
-is_pending = set()
-processed_jobs_db = sqlite3.connect("tvheadend-recordings.db", check_same_thread=False)
+done = False
+work_queue = PriorityQueue() # (-priority, sequence, recording, ssh host) awaiting download and analysis, highest priority then oldest first
+queue_sequence = count() # keeps recordings of equal priority in arrival order
+priority_rules = [] # (field, pattern or seconds, priority) from --priority
+operator_queue = None # analysed recordings which need the operator, bounded by --analysis-depth. None wakes the main thread
+topic_finished = None
+is_pending = {} # uuid -> ssh host of recordings queued for analysis or the operator
+pending_lock = threading.Lock()
+topic_hosts = {} # per-host finished recordings topic -> ssh host, when --topic-finished contains {host}
+sync_host = None # with one shared topic: the host being asked, the message itself does not say which host sent it. None drops messages
+sync_marks = {} # ssh host -> its entries which stopped at or before this were handled on an earlier run
+synced = {} # ssh host -> Event set once its finished recordings message has been handled
+host_newest = {} # ssh host -> newest stop time seen during this run, becomes its high-water mark once its recordings are drained
+split_after = 0 # seconds, recordings longer than this are published as segment sub-jobs (0 disables)
+segment_seconds = 0
+scratch_files = set() # per-uuid scratch recordings currently on disk
+scratch_reserved = {} # scratch recording -> bytes it was admitted with, counted until it leaves scratch
+scratch_lock = threading.RLock()
+scratch_freed = threading.Condition(scratch_lock) # notified as recordings leave scratch, for fetches waiting on the budget
+job_store = JobStore("tvheadend-recordings.db")
 
 def ok_recording(d:dict) -> bool:
    try:
@@ -40,23 +66,63 @@ def ok_recording(d:dict) -> bool:
       print(f"Rejecting recording as does not satisfy required metadata for operations: {d}")
       return False
 
-def fetch_recording(recording:dict, ssh_user: str, ssh_host:str, folder_prefix:str) -> str:
+def scratch_bytes_used() -> int:
+   total = 0
+   with scratch_lock:
+      for fname in scratch_files:
+         try:
+            size = os.path.getsize(fname)
+         except OSError:
+            size = 0
+         # a fetch just admitted has barely started, count what it will grow to
+         total += max(size, scratch_reserved.get(fname, 0))
+   return total
+
+def scratch_path(recording:dict, scratch_dir:str) -> str:
+   return os.path.join(scratch_dir, f"{recording['uuid']}.ts")
+
+def release_scratch_file(fname:str) -> None:
+   with scratch_lock:
+      scratch_files.discard(fname)
+      scratch_reserved.pop(fname, None)
+      try:
+         os.unlink(fname)
+      except FileNotFoundError:
+         pass
+      scratch_freed.notify_all()
+
+def remote_recording_size(recording:dict, ssh_user:str, ssh_host:str, folder_prefix:str) -> int:
+   st = remote_stat(ssh_user, ssh_host, f"{folder_prefix}/{os.path.basename(recording['filename'])}")
+   return st[0] if st else 0 # unknown, only the bytes already in scratch will count against the budget
+
+def wait_for_scratch_budget(local_file:str, needed_bytes:int, budget_bytes:int) -> bool:
+   # always permit a fetch when scratch is empty, otherwise a recording larger than the budget would never run.
+   # needed_bytes is reserved for local_file as it is admitted, so concurrent fetches cannot both pass the check
+   with scratch_freed:
+      while not done:
+         used = scratch_bytes_used()
+         if used == 0 or used + needed_bytes <= budget_bytes:
+            scratch_files.add(local_file)
+            scratch_reserved[local_file] = needed_bytes
+            return True
+         scratch_freed.wait(timeout=60)
+   return False
+
+def fetch_recording(recording:dict, ssh_user: str, ssh_host:str, folder_prefix:str, scratch_dir:str='/tmp', verify:str='size') -> str:
    assert len(ssh_user) > 0
    assert len(ssh_host) > 0
    assert folder_prefix is not None
    # we DO NOT use the filename field as given, instead we use a relative fetch for ~hts/recordings usually
    base_filename = os.path.basename(recording['filename'])
-   ssh_args = ["scp", f"{ssh_user}@{ssh_host}:{folder_prefix}/{base_filename}", "/tmp/recording.ts"]
-   print(f"Fetching recording using: {ssh_args}")
-   for retry in range(3):
-      exit_status = subprocess.call(ssh_args)
-      if exit_status == 0:
-         break
-      else:
-         print(f"Failed to recording {recording} (retry #{retry})- sleeping for 30s")
-         sleep(30)
-   assert exit_status == 0
-   return "/tmp/recording.ts" 
+   local_file = scratch_path(recording, scratch_dir)
+   with scratch_lock:
+      scratch_files.add(local_file)
+   # a partial copy left by an earlier attempt is resumed, and the source mtime (which keys the media info cache) is preserved
+   ok = fetch_file(ssh_user, ssh_host, f"{folder_prefix}/{base_filename}", local_file, verify=verify)
+   if not ok:
+      release_scratch_file(local_file)
+   assert ok
+   return local_file
 
 def get_int(prompt:str) -> int:
    ok = False
@@ -71,12 +137,9 @@ def get_int(prompt:str) -> int:
           print(f'You must supply a valid integer - not {input_str}')
           pass # try again
    
-def deduce_crop_settings(recording:dict) -> tuple:
-   # if the recording is ER we know ABC will have no black borders, so no crop needed
-   if recording['title']['eng'].startswith('ER'): 
-       return None # no crop arguments given to rkmppenc
-   # else we block and run handbrake locally and wait for the user to enter the data manually
-   exit_status = subprocess.call(["flatpak", "run", "--filesystem=/tmp", "fr.handbrake.ghb", "--device=/tmp/recording.ts"])
+def manual_crop_settings(local_file:str) -> tuple:
+   # block and run handbrake locally and wait for the user to enter the data manually
+   exit_status = subprocess.call(["flatpak", "run", f"--filesystem={os.path.dirname(local_file)}", "fr.handbrake.ghb", f"--device={local_file}"])
    print(f"Handbrake run: {exit_status}")  
    if exit_status > 0:
       return None 
@@ -90,16 +153,75 @@ def deduce_crop_settings(recording:dict) -> tuple:
    bottom_crop = get_int('Bottom crop? (0 means no crop) ')
    return (left_crop, top_crop, right_crop, bottom_crop)
 
-def deduce_interlace_settings(recording:dict, local_file:str) -> tuple:
+def cached_crop_settings(recording:dict, resolution:str):
+   # returns False if nothing cached, else the crop (which may be None ie. no crop)
+   row = job_store.read_one('SELECT crop FROM crop_settings WHERE channelname = :channelname AND title = :title AND resolution = :resolution;',
+                            { "channelname": recording['channelname'], "title": recording['title']['eng'], "resolution": resolution })
+   if not row:
+      return False
+   crop = json.loads(row[0])
+   return tuple(crop) if crop is not None else None
+
+def save_crop_settings(recording:dict, resolution:str, crop:tuple) -> None:
+   job_store.write('INSERT OR REPLACE INTO crop_settings VALUES (:channelname, :title, :resolution, :crop);',
+                   { "channelname": recording['channelname'], "title": recording['title']['eng'], "resolution": resolution, "crop": json.dumps(crop) })
+
+def crop_resolution(media_info:dict) -> str:
+   return f"{media_info['width']}x{media_info['height']}" if media_info else 'unknown'
+
+def deduce_crop_settings(recording:dict, local_file:str, media_info:dict, crop_review:str='disagree') -> tuple:
+   # returns (crop, needs_review): never blocks on the operator, so it is safe to run in the analysis threads
+   # if the recording is ER we know ABC will have no black borders, so no crop needed
+   if recording['title']['eng'].startswith('ER'): 
+       return (None, False) # no crop arguments given to rkmppenc
+   if crop_review == 'always':
+      return (None, True)
+   resolution = crop_resolution(media_info)
+   # later episodes of a series on the same channel have the same borders
+   crop = cached_crop_settings(recording, resolution)
+   if crop is not False:
+      print(f"Using cached crop settings {crop} for {recording['title']['eng']} on {recording['channelname']}")
+      return (crop, False)
+   crop, agreed = detect_crop(local_file, media_info)
+   if crop is not None and not any(crop):
+      crop = None # no borders found
+   if agreed:
+      save_crop_settings(recording, resolution, crop)
+      return (crop, False)
+   print(f"Crop detection samples disagree for {recording['title']['eng']} (best guess {crop})")
+   return (crop, crop_review != 'never')
+
+def review_crop_settings(recording:dict, local_file:str, media_info:dict) -> tuple:
+   # main thread only: HandBrake and the prompts need the operator
+   crop = manual_crop_settings(local_file)
+   # None is HandBrake failing or the operator omitting the crop for this recording, not an answer for the series
+   if crop is not None:
+      save_crop_settings(recording, crop_resolution(media_info), crop)
+   return crop
+
+def get_media_info(recording:dict, local_file:str) -> dict:
+   # probe each recording once, keyed on uuid plus source size and mtime so a replaced recording is re-probed
+   st = os.stat(local_file)
+   key = { "uuid": recording['uuid'], "size": st.st_size, "mtime": int(st.st_mtime) }
+   row = job_store.read_one('SELECT info FROM media_info WHERE uuid = :uuid AND size = :size AND mtime = :mtime;', key)
+   if row:
+      media_info = json.loads(row[0])
+      if valid_media_info(media_info):
+         print(f"Using cached media info for {recording['uuid']}")
+         return media_info
+   media_info = probe_media_info(local_file)
+   if media_info:
+      job_store.write('INSERT OR REPLACE INTO media_info VALUES (:uuid, :size, :mtime, :info);', dict(key, info=json.dumps(media_info, sort_keys=True)))
+   return media_info
+
+def deduce_interlace_settings(recording:dict, media_info:dict) -> tuple:
    # per https://stackoverflow.com/questions/24945378/progressive-or-interlace-detection-in-ffmpeg
-   ffprobe_results = subprocess.run(["ffprobe", "-v", "quiet", "-select_streams", "v", "-show_entries", "stream=codec_name,height,width,pix_fmt,field_order", "-of", "csv=p=0", local_file], capture_output=True)
-   if ffprobe_results.returncode == 0:
-      for line in ffprobe_results.stdout.decode('utf-8').split("\n"):
-         trimmed_line = line.rstrip()
-         if ",tb" in trimmed_line:
-            return ("--vpp-yadif", "--interlace", "tff")
-         elif ",bt" in trimmed_line:
-            return ("--vpp-yadif", "--interlace", "bff")
+   if media_info:
+      field_order = media_info.get('field_order')
+      if field_order == 'tb':
+         return ("--vpp-yadif", "--interlace", "tff")
+      elif field_order == 'bt':
+         return ("--vpp-yadif", "--interlace", "bff")
       # DONT FALLTHRU... assume progressive to avoid performance hit in unknown case
       return None
    else:
@@ -120,8 +242,9 @@ def deduce_output_res(recording:dict) -> tuple:
 def send_message(client, topic:str, payload: dict) -> None:
    json_str = json.dumps(payload, sort_keys=True)
    print(f"Sending to {topic} message {json_str}")
-   ret = client.publish(topic, json_str)
-   assert ret[0] == MQTTErrorCode.MQTT_ERR_SUCCESS
+   ret = client.publish(topic, json_str, qos=1) # QoS 1 so workers can hold back the ack until the job is done
+   # whilst disconnected paho queues a QoS 1 publish and sends it on reconnect, so NO_CONN is not a failure
+   assert ret[0] in (MQTTErrorCode.MQTT_ERR_SUCCESS, MQTTErrorCode.MQTT_ERR_NO_CONN)
 
 def deduce_output_filename(recording:dict)-> str:
    fname = os.path.basename(recording['filename'])
@@ -149,86 +272,285 @@ def deduce_output_filename(recording:dict)-> str:
    print(f"Proposed output filename for transcoded recording is {out_fname}")
    return out_fname
  
-def run_work(e:dict, ssh_user:str, ssh_host:str, folder_prefix:str, topic_rkmppenc:str, vbr:int=700) -> None: 
+def analyse_recording(e:dict, ssh_user:str, ssh_host:str, folder_prefix:str, scratch_dir:str='/tmp', crop_review:str='disagree', verify:str='size', fingerprint:str=None) -> dict:
    uuid = e['uuid']
    assert len(uuid) > 16
    print(f"Downloading {e['title']} (uuid {uuid}) to local computer... please wait")
-   local_file    = fetch_recording(e, ssh_user, ssh_host, folder_prefix)
    try:
+      with span(e.get('trace_id'), 'fetch', host=ssh_host):
+         local_file    = fetch_recording(e, ssh_user, ssh_host, folder_prefix, scratch_dir, verify)
+      print(f"Probing media info for {e['title']}")
+      with span(e.get('trace_id'), 'probe'):
+         media_info = get_media_info(e, local_file)
+      print(f"Media info is {media_info}")
       print(f"Determining crop settings for {e['title']}")
-      crop_settings = deduce_crop_settings(e)
-      print(f"Crop settings are {crop_settings}")
-      print(f"Determining interlace settings for {e['title']}")
-      interlace_settings = deduce_interlace_settings(e, local_file) 
-      print(f"Interlace settings are {interlace_settings}")
-      print(f"Determining output resolution settings for {e['title']}")
-      output_res    = deduce_output_res(e) 
-      print(f"Output resolution explicitly set to {output_res}")
-      # recording is ok so we request it be transcoded with the specified settings (dont care who does it)
-      send_message(client, topic_rkmppenc, { 
-         # target filename
-         "recording_file": e['filename'], 
-         # rkmppenc settings as required
-         "crop_settings": crop_settings, 
-         "interlace_settings": interlace_settings, 
-         "output_res": output_res,
-         "preferred_output_filename": deduce_output_filename(e),
-         # since we have multiple servers the worker needs to know how to fetch the recording - trusted?
-         "ssh_user": ssh_user,
-         "ssh_host": ssh_host,
-         "ssh_folder_prefix": folder_prefix,
-         "vbr": vbr
-      })
-      is_pending.discard(e['uuid'])
+      with span(e.get('trace_id'), 'cropdetect') as attrs:
+         crop_settings, needs_review = deduce_crop_settings(e, local_file, media_info, crop_review)
+         attrs['needs_review'] = needs_review
+   except BaseException:
+      # eg. ffprobe missing: the recording (and its share of the scratch budget) must not outlive the failed job
+      release_scratch_file(scratch_path(e, scratch_dir))
+      raise
+   print(f"Crop settings are {crop_settings} (operator review needed: {needs_review})")
+   job_store.set_state(uuid, 'analysed')
+   return { "recording": e, "ssh_user": ssh_user, "ssh_host": ssh_host, "ssh_folder_prefix": folder_prefix, "local_file": local_file,
+            "media_info": media_info, "crop_settings": crop_settings, "needs_review": needs_review, "fingerprint": fingerprint }
+
+def parse_priority_rule(rule:str) -> tuple:
+   # channel:<regex>=<priority>, title:<regex>=<priority> or shorter:<minutes>=<priority>
+   what, priority = rule.rsplit('=', 1)
+   field, value = what.split(':', 1)
+   if field in ('channel', 'title'):
+      return (field, re.compile(value, re.IGNORECASE), int(priority))
+   if field == 'shorter':
+      return (field, float(value) * 60, int(priority))
+   raise ValueError(f"unknown priority rule field {field}")
+
+def recording_priority(e:dict) -> int:
+   # the highest priority of the matching --priority rules, 0 if none match
+   matched = []
+   for field, value, priority in priority_rules:
+      if field == 'channel' and value.search(e['channelname']):
+         matched.append(priority)
+      elif field == 'title' and value.search(e['title']['eng']):
+         matched.append(priority)
+      elif field == 'shorter' and 0 < entry_stop(e) - float(e.get('start_real') or e.get('start') or 0) < value:
+         matched.append(priority)
+   return max(matched, default=0)
+
+def publish_job(analysis:dict, topic_rkmppenc:str, vbr:int=700) -> dict:
+   e = analysis['recording']
+   print(f"Determining interlace settings for {e['title']}")
+   interlace_settings = deduce_interlace_settings(e, analysis['media_info']) 
+   print(f"Interlace settings are {interlace_settings}")
+   print(f"Determining output resolution settings for {e['title']}")
+   output_res    = deduce_output_res(e) 
+   print(f"Output resolution explicitly set to {output_res}")
+   # recording is ok so we request it be transcoded with the specified settings (dont care who does it)
+   job = { 
+      # identifies the job in worker heartbeats and results
+      "uuid": e['uuid'],
+      # target filename
+      "recording_file": e['filename'], 
+      # rkmppenc settings as required
+      "crop_settings": analysis['crop_settings'], 
+      "interlace_settings": interlace_settings, 
+      "output_res": output_res,
+      "preferred_output_filename": deduce_output_filename(e),
+      # probed once here so the worker need not run ffprobe again
+      "media_info": analysis['media_info'],
+      # since we have multiple servers the worker needs to know how to fetch the recording - trusted?
+      "ssh_user": analysis['ssh_user'],
+      "ssh_host": analysis['ssh_host'],
+      "ssh_folder_prefix": analysis['ssh_folder_prefix'],
+      # see tracing.py, published_at lets the worker time the wait in the broker
+      "trace_id": e.get('trace_id'),
+      # higher is sooner, workers and job-dispatcher.py take jobs in priority order (see --priority)
+      "priority": e.get('priority', 0),
+      # identifies the recording's content, so a worker can tell it has already encoded it (see run-rkmppenc.py)
+      "fingerprint": analysis['fingerprint'],
+      "vbr": vbr
+   }
+   # lets a dispatcher balance boards by the work in each job rather than the number of jobs
+   job['cost'] = job_cost(job)
+   with span(e.get('trace_id'), 'split'):
+      segments = split_recording(analysis)
+   if not any(segments):
+      with span(e.get('trace_id'), 'publish'):
+         job['published_at'] = time()
+         send_message(client, topic_rkmppenc, job)
+      return job
+   # long recording: any worker may encode any segment, the last to finish joins them into preferred_output_filename
+   for segment in segments:
+      sub_job = dict(job,
+         preferred_output_filename=part_filename(e['uuid'], segment['index']),
+         media_info=dict(analysis['media_info'], duration=segment['end'] - segment['start'], size=segment['length']),
+         segment=dict(segment, group=e['uuid'], output=job['preferred_output_filename'], duration=analysis['media_info']['duration']))
+      sub_job['cost'] = job_cost(sub_job)
+      with span(e.get('trace_id'), 'publish', segment=segment['index']):
+         sub_job['published_at'] = time()
+         send_message(client, topic_rkmppenc, sub_job)
+   return dict(job, segments=len(segments))
+
+def split_recording(analysis:dict) -> list:
+   media_info = analysis['media_info']
+   if split_after <= 0 or not media_info or not media_info.get('duration') or media_info['duration'] <= split_after:
+      return []
+   keyframes = probe_keyframes(analysis['local_file'])
+   if not any(keyframes):
+      print(f"Unable to find keyframes in {analysis['local_file']}... publishing as a single job")
+      return []
+   segments = plan_segments(keyframes, media_info['duration'], os.path.getsize(analysis['local_file']), segment_seconds)
+   print(f"Splitting {analysis['recording']['title']} into {len(segments)} segments: {[(round(s['start']), round(s['end'])) for s in segments]}")
+   return segments if len(segments) > 1 else []
+
+def finish_job(analysis:dict, state:str, job:dict=None) -> None:
+   e = analysis['recording']
+   uuid = e['uuid']
+   release_scratch_file(analysis['local_file'])
+   # once published or skipped dont process this uuid again, failures are retried on the next run
+   job_store.set_state(uuid, state, job)
+   if state == 'published' and analysis.get('fingerprint'):
+      job_store.set_fingerprint(analysis['fingerprint'], uuid, analysis['ssh_host'])
+   job_done(uuid)
+   print(f"Finished processing {e['title']} (uuid {uuid}): {state}")
+
+def job_done(uuid:str) -> None:
+   # no more work for this uuid in this run. Wakes the main thread once a host has nothing pending, so its
+   # high-water mark can be saved and the run can end as soon as everything is drained rather than on the next poll
+   with pending_lock:
+      host = is_pending.pop(uuid, None)
+      drained = host is not None and host not in is_pending.values()
+   if drained:
+      try:
+         operator_queue.put_nowait(None)
+      except Full:
+         pass # the main thread has reviews to do and checks again after each one
+
+def drained_hosts() -> list:
+   with pending_lock:
+      return [host for host in host_newest if host not in is_pending.values()]
+
+def analysis_worker(ssh_user:str, folder_prefix:str, scratch_dir:str, budget_bytes:int, topic_rkmppenc:str, vbr:int, crop_review:str, verify:str) -> None:
+   # runs in its own thread: download/probe/crop-detect ahead of the operator. Jobs which need no operator are published directly
+   while not done:
+      try:
+         priority, sequence, e, ssh_host = work_queue.get(block=True, timeout=10)
+      except Empty:
+         continue
+      record_span(e.get('trace_id'), 'queue_wait', e.get('seen_at'), time())
+      try:
+         # the same programme may turn up under another uuid eg. recorded on two hosts, no need to fetch it again
+         with span(e.get('trace_id'), 'fingerprint'):
+            fingerprint = remote_fingerprint(ssh_user, ssh_host, f"{folder_prefix}/{os.path.basename(e['filename'])}")
+         duplicate = job_store.duplicate_of(fingerprint, e['uuid'])
+         if duplicate:
+            print(f"{e['title']} (uuid {e['uuid']}) on {ssh_host} has the same content as {duplicate}... skipping")
+            job_store.set_state(e['uuid'], 'skipped', { "duplicate_of": duplicate, "fingerprint": fingerprint })
+            job_done(e['uuid'])
+            continue
+         with span(e.get('trace_id'), 'scratch_wait'):
+            budget_ok = wait_for_scratch_budget(scratch_path(e, scratch_dir), remote_recording_size(e, ssh_user, ssh_host, folder_prefix), budget_bytes)
+         if not budget_ok:
+            job_done(e['uuid'])
+            break
+         analysis = analyse_recording(e, ssh_user, ssh_host, folder_prefix, scratch_dir, crop_review, verify, fingerprint)
+      except Exception:
+         traceback.print_exc()
+         print(f"Unable to analyse {e['title']} (uuid {e['uuid']})... will retry on next run")
+         job_store.set_state(e['uuid'], 'failed')
+         job_done(e['uuid'])
+         continue
+      if not analysis['needs_review']:
+         try:
+            finish_job(analysis, 'published', publish_job(analysis, topic_rkmppenc, vbr))
+         except Exception:
+            traceback.print_exc()
+            finish_job(analysis, 'failed')
+         continue
+      queued = False
+      while not queued and not done:
+         try:
+            analysis['queued_at'] = time()
+            operator_queue.put(analysis, block=True, timeout=10)
+            queued = True
+         except Full:
+            pass
+      if not queued:
+         release_scratch_file(analysis['local_file'])
+         job_done(analysis['recording']['uuid'])
+
+def run_work(analysis:dict, topic_rkmppenc:str, vbr:int=700) -> None: 
+   # main thread: recording has already been downloaded and analysed, only the operator is needed
+   e = analysis['recording']
+   state = 'failed'
+   job = None
+   try:
+      print(f"Operator review of crop settings for {e['title']}")
+      record_span(e.get('trace_id'), 'operator_wait', analysis.get('queued_at'), time())
+      with span(e.get('trace_id'), 'review'):
+         analysis['crop_settings'] = review_crop_settings(e, analysis['local_file'], analysis['media_info'])
+      print(f"Crop settings are {analysis['crop_settings']}")
+      job = publish_job(analysis, topic_rkmppenc, vbr)
+      state = 'published'
    except SkipJob:
-      pass
+      state = 'skipped'
    finally:
-      os.unlink(local_file)
-      # if we get here dont process this uuid again since it has been marked as to be transcoded
-      with processed_jobs_db as con:
-         cursor = con.cursor()
-         result = cursor.execute(f'INSERT INTO uuid_recordings VALUES (:uuid);', { "uuid": uuid })
-         con.commit()
-         print(result)
-         print(f"Finished processing {e['title']} (uuid {uuid})")
-
-
-def done_before(uuid:str) -> bool:
-   results = processed_jobs_db.execute(f'select count(*) from uuid_recordings where uuid = "{uuid}";')
-   t = results.fetchone()
-   assert isinstance(t, tuple)
-   if t[0] > 0:
-      print(f"Skipping recording with UUID {uuid} since it has already been processed.")
-   return (t[0] > 0)
+      finish_job(analysis, state, job)
+
 
 def on_message(client, userdata, message):
-   if 'tvheadend' not in message.topic:
+   if message.topic != topic_finished and message.topic not in topic_hosts:
       # disabled due to verbosity
       #print(f"Ignoring message from {message.topic}")
       return
+   host = topic_hosts.get(message.topic, sync_host)
+   if host is None or synced[host].is_set():
+      # eg. a host answering after its sync timed out, which must not be taken for another host's recordings
+      print(f"Finished recordings message on {message.topic} arrived outside its host's sync... ignored")
+      return
+   try:
+      queue_entries(message, host)
+   finally:
+      synced[host].set()
 
-   json_str = message.payload.decode('utf-8') 
-   assert isinstance(json_str, str)
-   d = json.loads(json_str) 
-   print(d)
-   assert isinstance(d, dict)
-   assert 'entries' in d.keys()
-   l = d['entries']
-   print(f'Finished recording message: found {len(l)} completed recordings')
+def queue_entries(message, host:str) -> None:
+   total = 0
+   candidates = []
+   sync_mark = sync_marks[host]
+   newest = host_newest.get(host, 0.0)
+   try:
+      for e in iter_entries(message.payload):
+         total = total + 1
+         if not isinstance(e, dict) or 'uuid' not in e:
+            continue
+         stop = entry_stop(e)
+         newest = max(newest, stop)
+         # incremental sync: older entries are only looked at again if they never finished
+         if stop <= sync_mark and not job_store.is_unfinished(e['uuid']):
+            continue
+         candidates.append(e)
+   except ValueError as ve:
+      print(f"Invalid finished recordings message on {message.topic}: {ve}... ignoring")
+      return
+   host_newest[host] = newest
+   print(f'Finished recording message from {host}: found {total} completed recordings, {len(candidates)} newer than {sync_mark} or unfinished')
+   # one in-memory lookup for the whole message rather than a query per entry
+   not_done = job_store.pending_uuids([e['uuid'] for e in candidates])
+   print(f"Skipping {len(candidates) - len(not_done)} recordings which have already been processed")
    done_recordings = 0
-   for idx, e in enumerate(l):
+   for idx, e in enumerate(candidates):
+      if e['uuid'] not in not_done:
+         continue
       if e['uuid'] in is_pending:
          print(f"{e['uuid']} is already a pending job... ignored")
          continue
-      if ok_recording(e) and not done_before(e['uuid']):
-         work_queue.put(e)
-         is_pending.add(e['uuid'])
+      if ok_recording(e):
+         # the trace follows this recording through both scripts, see tracing.py
+         e['trace_id'] = new_trace_id()
+         e['seen_at'] = time()
+         e['priority'] = recording_priority(e)
+         job_store.set_state(e['uuid'], 'seen')
+         with pending_lock:
+            is_pending[e['uuid']] = host
+         work_queue.put((-e['priority'], next(queue_sequence), e, host))
          done_recordings = done_recordings + 1
    print(f"Processed {done_recordings} recordings which were submitted to rkmppenc")
 
+def finished_command(ssh_host:str) -> list:
+   # has the host's tvheadend-mqtt publish its finished recordings
+   return ssh_command(None, ssh_host, "docker", "exec", "tvheadend-mqtt", "/app/bin/main", "publish", "finished")
+
 def on_connect(client, userdata, flags, rc, properties):
    print(f"Connected with result code {rc}")
    client.subscribe("$SYS/#")
+   # here rather than after connect() so the subscription is restored whenever paho reconnects
+   for topic in (topic_hosts or [topic_finished]):
+      client.subscribe(topic)
+
+def on_disconnect(client, userdata, flags, rc, properties):
+   # paho reconnects by itself (loop_start) and on_connect resubscribes, published jobs are QoS 1 so are resent
+   print(f"Disconnected with result code {rc}... will reconnect")
 
 
 if __name__ == "__main__":
@@ -238,39 +560,109 @@ if __name__ == "__main__":
    a.add_argument('--ssh-folder-prefix', help='Subfolder to fetch recordings from [recordings] ', type=str, default='recordings')
    a.add_argument('--mqtt-broker', help='MQTT Broker hostname to use [opi2.lan] ', type=str, default='opi2.lan')
    a.add_argument('--mqtt-port', help='TCP port to use on broker [8883] ', type=int, default=8883)
-   a.add_argument('--topic-finished', help='Input recordings from tvheadend are posted to this topic [tvheadend/finished] ', type=str, default='tvheadend/finished')
+   a.add_argument('--topic-finished', help='Input recordings from tvheadend are posted to this topic. With {host} in it (eg. tvheadend/{host}/finished, set in each host\'s tvheadend-mqtt) all --ssh-host are synced at once [tvheadend/finished] ', type=str, default='tvheadend/finished')
    a.add_argument('--topic-transcode', help='Transcode jobs are submitted to this topic [video/mpp] ', type=str, default='video/mpp')
    a.add_argument('--cafile', help='Certificate Authority certificate [ca.crt] ', type=str, default='ca.crt')
    a.add_argument('--cert', help='Host certificate to provide to MQTT Broker [hplappie.lan.crt] ', type=str, default='hplappie.lan.crt')
    a.add_argument('--key', help='Host private key [hplappie.lan.key] ', type=str, default='hplappie.lan.key')
    a.add_argument('--vbr', help='Variable bitrate (kb/s) to use [700] ', type=int, default=700) 
+   a.add_argument('--scratch-dir', help='Folder to download recordings into for analysis [/tmp] ', type=str, default='/tmp')
+   a.add_argument('--scratch-budget', help='Maximum GB of recordings to hold in the scratch folder [20] ', type=float, default=20.0)
+   a.add_argument('--analysis-workers', help='Number of recordings to download and analyse concurrently [2] ', type=int, default=2)
+   a.add_argument('--analysis-depth', help='Maximum analysed recordings waiting for the operator [4] ', type=int, default=4)
+   a.add_argument('--verify', help='How to check a downloaded recording against the source: size or sha256 [size] ', type=str, choices=['size', 'sha256'], default='size')
+   a.add_argument('--split-after', help='Publish recordings longer than this many minutes as segments which workers encode in parallel, 0 to disable [0] ', type=float, default=0)
+   a.add_argument('--segment-minutes', help='Approximate length of each segment when splitting [20] ', type=float, default=20)
+   a.add_argument('--full-sync', help='Consider every finished recording, ignoring the per-host high-water marks from earlier runs [False] ', action='store_true')
+   a.add_argument('--sync-timeout', help='Seconds to wait for a host to publish its finished recordings once asked [120] ', type=int, default=120)
+   a.add_argument('--priority', help='Rule giving matching recordings a priority, higher is encoded sooner, the highest matching rule applies: channel:<regex>=<n>, title:<regex>=<n> or shorter:<minutes>=<n>. May be repeated [] ',
+                  type=parse_priority_rule, action='append', default=[])
+   a.add_argument('--trace-file', help='Append per-stage timings of each job to this JSONL file for trace-report.py, empty to disable [] ', type=str, default='')
+   a.add_argument('--crop-review', help='When to ask the operator to confirm crop settings via HandBrake: never, disagree (automatic samples differ) or always [disagree] ', type=str, choices=['never', 'disagree', 'always'], default='disagree')
    args = a.parse_args()
+   assert args.analysis_workers >= 1
+   assert args.segment_minutes > 0
+   split_after = args.split_after * 60
+   segment_seconds = args.segment_minutes * 60
+   operator_queue = Queue(maxsize=args.analysis_depth)
+   topic_finished = args.topic_finished
+   ssh_hosts = args.ssh_host.split(',')
+   for ssh_host in ssh_hosts:
+      sync_marks[ssh_host] = 0.0 if args.full_sync else job_store.high_water(ssh_host)
+      synced[ssh_host] = threading.Event()
+   if '{host}' in topic_finished:
+      topic_hosts = { topic_finished.format(host=ssh_host): ssh_host for ssh_host in ssh_hosts }
+   priority_rules = args.priority
+   open_trace(args.trace_file, f"publisher@{socket.gethostname()}")
    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5)
    client.on_message = on_message
    client.on_connect = on_connect
-   client.tls_set(ca_certs=args.cafile, certfile=args.cert, keyfile=args.key)
+   client.on_disconnect = on_disconnect
+   client.reconnect_delay_set(min_delay=1, max_delay=60)
+   if args.cafile: # empty for a plain TCP broker eg. the benchmark's stand-in
+      client.tls_set(ca_certs=args.cafile, certfile=args.cert, keyfile=args.key)
    client.connect(args.mqtt_broker, port=args.mqtt_port)
    client.loop_start()
-   client.subscribe(args.topic_finished)
-   print(f"Subscribed to {args.topic_finished} topic... now waiting for recordings...")
+   print(f"Subscribing to {args.topic_finished} topic... now waiting for recordings...")
+   analysers = [threading.Thread(target=analysis_worker, args=(args.ssh_user, args.ssh_folder_prefix, args.scratch_dir, int(args.scratch_budget * 1024 * 1024 * 1024), args.topic_transcode, args.vbr, args.crop_review, args.verify), daemon=True)
+                for i in range(args.analysis_workers)]
+   for t in analysers:
+      t.start()
    
-   for ssh_host in args.ssh_host.split(','):
-      # run get finished recordings on current target host
-      results = subprocess.run(["ssh", ssh_host, "docker", "exec", "tvheadend-mqtt", "/app/bin/main", "publish", "finished"])
-      print(results)
-      assert results.returncode == 0
+   try:
+      if any(topic_hosts):
+         # each host answers on its own topic, so they are all asked at once
+         triggers = { ssh_host: subprocess.Popen(finished_command(ssh_host)) for ssh_host in ssh_hosts }
+         deadline = time() + args.sync_timeout
+         for ssh_host, trigger in triggers.items():
+            if trigger.wait() != 0:
+               print(f"Unable to ask {ssh_host} for its finished recordings (exit status {trigger.returncode})... skipping it this run")
+            elif not synced[ssh_host].wait(timeout=max(0, deadline - time())):
+               print(f"No finished recordings message from {ssh_host} within {args.sync_timeout}s... skipping it this run")
+      else:
+         # on one shared topic the hosts are asked in turn, but only until each message arrives: every host's recordings
+         # are then downloaded and analysed side by side by the analysers
+         for ssh_host in ssh_hosts:
+            sync_host = ssh_host
+            results = subprocess.run(finished_command(ssh_host))
+            print(results)
+            assert results.returncode == 0
+            if not synced[ssh_host].wait(timeout=args.sync_timeout):
+               # its message may still turn up, and could not then be told apart from the next host's
+               sync_host = None
+               print(f"No finished recordings message from {ssh_host} within {args.sync_timeout}s... asking no more hosts this run")
+               break
+         sync_host = None
 
-      # slow process things in main thread one-at-a-time ie. user interaction since not permitted in callback thread
-      try:
-         sleep(10)
-         while True:
-            r = work_queue.get(block=True, timeout=10) 
-            print(f"Analysing recording {r}")
-            run_work(r, ssh_user=args.ssh_user, ssh_host=ssh_host, folder_prefix=args.ssh_folder_prefix, topic_rkmppenc=args.topic_transcode, vbr=args.vbr)
-      except Empty:
-         # not done, just nothing reported for now, keep going
-         print(f"No more unprocessed recordings for {ssh_host}")
-         continue
+      # user interaction in main thread one-at-a-time since not permitted in callback thread. Woken by each analysed
+      # recording needing review, and by job_done() whenever a host drains
+      while True:
+         for ssh_host in drained_hosts():
+            print(f"No more unprocessed recordings for {ssh_host}")
+            job_store.set_high_water(ssh_host, host_newest.pop(ssh_host))
+         with pending_lock:
+            if not any(is_pending):
+               break
+         r = operator_queue.get(block=True)
+         if r is not None:
+            print(f"Reviewing recording {r['recording']}")
+            run_work(r, topic_rkmppenc=args.topic_transcode, vbr=args.vbr)
+   except KeyboardInterrupt:
+      print("Interrupted... removing scratch recordings")
+   done = True
+   with scratch_freed:
+      scratch_freed.notify_all()
+   for t in analysers:
+      t.join(timeout=30)
+   with scratch_lock:
+      remaining = list(scratch_files)
+   for fname in remaining:
+      release_scratch_file(fname)
+   client.disconnect()
    client.loop_stop()
+   job_store.close()
+   close_trace()
+   close_connections(args.ssh_user, ssh_hosts)
+   close_connections(None, ssh_hosts)
    print(f"Finished submitted jobs for all hosts {args.ssh_host}... run completed successfully.")
    exit(0)